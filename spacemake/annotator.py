@@ -9,8 +9,10 @@ import logging
 import ncls
 import itertools
 import pickle
+import json
+import gc
 from time import time
-from collections import defaultdict, OrderedDict, deque
+from collections import defaultdict, OrderedDict, Counter, deque
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -29,11 +31,43 @@ def attr_to_dict(attr_str):
     return d
 
 
+def attr_getter(key):
+    """
+    Returns a function that extracts only the value of <key> from the GTF
+    attribute column (col 9). Searching for the literal key is much faster than
+    parsing all key, value pairs with attr_to_dict().
+    """
+    pattern = re.compile(re.escape(key) + r' "(\S+)";')
+
+    def get(attr_str):
+        m = pattern.search(attr_str)
+        # make sure we did not match the end of a longer key
+        while m and m.start():
+            prev = attr_str[m.start() - 1]
+            if not (prev.isalnum() or prev == "_"):
+                break
+
+            m = pattern.search(attr_str, m.end())
+
+        if m is None:
+            raise KeyError(key)
+
+        return m.group(1)
+
+    return get
+
+
 def load_GTF(
     src,
     attributes=["gene_id", "gene_type", "gene_name"],
     features=["exon", "CDS", "UTR"],
 ):
+    """
+    Streaming GTF parser. Lines are filtered by the feature column first, and
+    only the requested attributes are extracted (instead of parsing all of
+    them with attr_to_dict()). Values are collected column by column and stored
+    as categoricals where that makes sense.
+    """
     if type(src) is str:
         if src.endswith(".gz"):
             src = gzip.open(src, "rt")
@@ -41,26 +75,81 @@ def load_GTF(
             src = open(src, "rt")
 
     fset = set(features)
-    data = []
+    getters = [attr_getter(a) for a in attributes]
+    chroms = []
+    feats = []
+    starts = []
+    ends = []
+    strands = []
+    attr_values = [[] for a in attributes]
     for line in src:
         parts = line.split("\t")
         if len(parts) != 9:
             # not a GFF formatted line
             continue
 
-        chrom, source, feature, start, end, score, strand, frame, attr_str = parts
-        if feature not in fset:
+        if parts[2] not in fset:
             continue
 
-        attrs = attr_to_dict(attr_str)
-        row = [chrom, feature, int(start) - 1, int(end), strand] + [
-            attrs[a] for a in attributes
-        ]
-        data.append(row)
+        attr_str = parts[8]
+        for get, values in zip(getters, attr_values):
+            values.append(get(attr_str))
+
+        chroms.append(parts[0])
+        feats.append(parts[2])
+        starts.append(parts[3])
+        ends.append(parts[4])
+        strands.append(parts[6])
+
+    data = OrderedDict(
+        chrom=pd.Categorical(chroms),
+        feature=pd.Categorical(feats),
+        start=np.array(starts, dtype=np.int64) - 1,
+        end=np.array(ends, dtype=np.int64),
+        strand=pd.Categorical(strands),
+    )
+    for a, values in zip(attributes, attr_values):
+        data[a] = pd.Categorical(values)
+
+    return pd.DataFrame(data).drop_duplicates().reset_index(drop=True)
+
+
+def store_table(df, path):
+    """
+    Store the tabular version of the GTF features. The format is determined
+    by the file extension: .feather and .parquet are much faster to re-load
+    (but require pyarrow), everything else is written as tab-separated text.
+    """
+    if path.endswith(".feather"):
+        df.to_feather(path)
+    elif path.endswith(".parquet"):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, sep="\t")
+
+
+def load_table(path):
+    if path.endswith(".feather"):
+        return pd.read_feather(path)
+    elif path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    else:
+        return pd.read_csv(path, sep="\t")
+
+
+def table_is_current(path, gtf):
+    """
+    True if the tabular cache at <path> exists and is not older than <gtf>.
+    A stale table must not be used, or a re-compiled index would carry the
+    signature of the new GTF but the features of the old one.
+    """
+    if not path or not os.access(path, os.R_OK):
+        return False
 
-    return pd.DataFrame(
-        data, columns=["chrom", "feature", "start", "end", "strand"] + attributes
-    ).drop_duplicates()
+    if not gtf or not os.access(gtf, os.R_OK):
+        return True
+
+    return os.stat(path).st_mtime_ns >= os.stat(gtf).st_mtime_ns
 
 
 ## Annotation classification matrix
@@ -82,6 +171,7 @@ class GTFClassifier:
         df,
         hierarchy=["CDS", "UTR", "non-coding", "intron"],
         feature_map=default_map,
+        cache_size=100000,
     ):
         self.feature_map = feature_map
         self.hierarchy = hierarchy
@@ -95,19 +185,52 @@ class GTFClassifier:
             "exon": 2,
             # "transcript": 3,
         }
-        df["feature_idx"] = df["feature"].apply(lambda x: feat2idx[x])
-        self.df = df.values
+        df["feature_idx"] = df["feature"].map(feat2idx).astype(int)
+        self.df = df[
+            ["strand", "gene_id", "gene_type", "gene_name", "feature_idx"]
+        ].values
+
+        # LRU cache of classifications, keyed by the feature ids in iteration
+        # order. Equal frozensets can iterate in different orders, and the
+        # order of the tags follows it. Reads from the same locus overlap the
+        # same features over and over.
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def process(self, ids):
+        """
+        Classify a frozenset of overlapping feature ids, using the LRU cache if
+        enabled. The returned lists are shared between all callers and must not
+        be modified.
+        """
+        if not self.cache_size:
+            return self.classify(ids)
+
+        key = tuple(ids)
+        res = self.cache.get(key)
+        if res is not None:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+            return res
+
+        self.cache_misses += 1
+        res = self.classify(ids)
+        self.cache[key] = res
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return res
+
+    def classify(self, ids):
         gene_features = defaultdict(lambda: np.zeros(3, dtype=bool))
         gene_names = {}
         gene_types = {}
         # iterate over the overlapping GTF features only once.
         # sort by gene_id as we go
         for i in ids:
-            row = self.df[i][5:]
-            # print(row)
-            (strand, gene_id, gene_type, gene_name, feature_idx) = row
+            (strand, gene_id, gene_type, gene_name, feature_idx) = self.df[i]
             gene_names[gene_id] = gene_name
             gene_types[gene_id] = gene_type
             # feature_idx encodes CDS, UTR, exon, transcript records
@@ -147,21 +270,20 @@ class GTFClassifier:
 
 
 class CompiledClassifier:
-    def __init__(self, df, classifications):
-        self.cid_table = df["cid"].values
-        self.classifications = np.array(classifications, dtype=object)
+    def __init__(self, cid_table, classifications):
+        self.cid_table = cid_table
+        self.classifications = classifications
 
     @staticmethod
     def get_filenames(path):
-        cdf_path = os.path.join(path, "non_overlapping.csv")
-        cclass_path = os.path.join(path, "classifications.npy")
-
-        return cdf_path, cclass_path
+        return CompiledIndex.get_filename(path)
 
     @staticmethod
     def files_exist(path):
-        cdf_path, cclass_path = CompiledClassifier.get_filenames(path)
-        return os.access(cdf_path, os.R_OK) and os.access(cclass_path, os.R_OK)
+        if not path:
+            return False
+
+        return os.access(CompiledIndex.get_filename(path), os.R_OK)
 
     # The only piece of work left is merging multiple pre-classified annotations
     def joiner(self, cidx):
@@ -194,6 +316,410 @@ class CompiledClassifier:
         return self.joiner(cidx)
 
 
+class InternedClassifications:
+    """
+    Array-backed replacement for the object array of pre-classified feature
+    combinations. Every distinct string is stored only once, each
+    classification is a run of rows in an (n, 4) array of string ids
+    (gf, gn, gs, gt). Classifications are materialized on first access.
+
+    In addition, each classification is pre-rendered into its final BAM tag
+    values (the comma-joined gF, gN, gS, gT strings), which are interned in a
+    second string table. tags() then costs a single lookup per read.
+    """
+
+    tag_names = ("gF", "gN", "gS", "gT")
+    intergenic = [("gF", "INTERGENIC")]
+
+    def __init__(self, strings, offsets, entries, tag_strings, tag_ids):
+        self.strings = strings
+        # plain ndarray views are much cheaper to slice than np.memmap
+        self.offsets = np.asarray(offsets)
+        self.entries = np.asarray(entries)
+        self.tag_strings = tag_strings
+        self.tag_ids = np.asarray(tag_ids)
+        self._cache = {}
+        self._tag_cache = {}
+        self._pair_cache = {}
+
+    @classmethod
+    def from_classifications(cls, classifications):
+        sid = {}
+        tsid = {}
+        offsets = [0]
+        entries = []
+        tag_ids = []
+        for res in classifications:
+            for ann in zip(*res):
+                entries.append([sid.setdefault(x, len(sid)) for x in ann])
+            offsets.append(len(entries))
+            tag_ids.append([tsid.setdefault(",".join(x), len(tsid)) for x in res])
+
+        return cls(
+            list(sid.keys()),
+            np.array(offsets, dtype=np.uint32),
+            np.array(entries, dtype=np.uint32).reshape(-1, 4),
+            list(tsid.keys()),
+            np.array(tag_ids, dtype=np.uint32).reshape(-1, 4),
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, cid):
+        res = self._cache.get(cid)
+        if res is None:
+            rows = self.entries[self.offsets[cid] : self.offsets[cid + 1]].tolist()
+            if rows:
+                res = tuple([self.strings[i] for i in col] for col in zip(*rows))
+            else:
+                res = ([], [], [], [])
+            self._cache[cid] = res
+
+        return res
+
+    def tags(self, cid):
+        """
+        BAM tags for a classification, as GenomeAnnotation.make_tags() would
+        return them. The list is shared and must not be modified.
+        """
+        res = self._tag_cache.get(cid)
+        if res is None:
+            if self.offsets[cid] == self.offsets[cid + 1]:
+                res = self.intergenic
+            else:
+                ids = self.tag_ids[cid].tolist()
+                res = [(t, self.tag_strings[i]) for t, i in zip(self.tag_names, ids)]
+            self._tag_cache[cid] = res
+
+        return res
+
+    def pair_tags(self, cid, cid_as):
+        """
+        BAM tags for the combination of a sense and an antisense classification.
+        Either may be None if there is no annotation on that strand. Rendered
+        once per distinct pair and shared, like tags().
+        """
+        key = (cid, cid_as)
+        res = self._pair_cache.get(key)
+        if res is None:
+            if cid_as is None:
+                res = self.intergenic if cid is None else self.tags(cid)
+            elif cid is None:
+                res = self.tags(cid_as)
+            else:
+                res = GenomeAnnotation.make_tags(
+                    *[a + b for a, b in zip(self[cid], self[cid_as])]
+                )
+            self._pair_cache[key] = res
+
+        return res
+
+
+def gtf_signature(gtf):
+    """
+    Describes the source GTF of a compiled index (size, mtime and md5 checksum)
+    so that a stale index can be detected.
+    """
+    import hashlib
+
+    if not gtf or not os.access(gtf, os.R_OK):
+        return {}
+
+    st = os.stat(gtf)
+    h = hashlib.md5()
+    with open(gtf, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+
+    return dict(size=st.st_size, mtime=st.st_mtime_ns, md5=h.hexdigest())
+
+
+class CompiledIndex:
+    """
+    Single-file, memory-mappable on-disk representation of a compiled
+    GenomeAnnotation.
+
+    Layout: MAGIC | uint64 header length | JSON header | aligned raw arrays.
+    The JSON header holds the format version, the signature of the source GTF,
+    the row-range of each (chrom, strand) and the interned string table.
+    The arrays hold the sorted segment starts, ends and combination ids
+    (cid) of all strands, concatenated, plus the classification table and a
+    strand-agnostic view of the segments (see merge_strands()).
+    Arrays are opened with np.memmap(mode="r"), so loading takes milliseconds
+    and parallel workers share the same pages.
+    """
+
+    MAGIC = b"SPACEMAKE_ANN\x00\x00\x00"
+    VERSION = 3
+    ALIGN = 64
+    STRANDS = ("+", "-")
+    logger = logging.getLogger("CompiledIndex")
+
+    def __init__(
+        self,
+        strand_ranges,
+        starts,
+        ends,
+        cids,
+        classifications,
+        merged=None,
+        header=None,
+    ):
+        self.strand_ranges = strand_ranges
+        self.starts = starts
+        self.ends = ends
+        self.cids = cids
+        self.classifications = classifications
+        self.header = header if header is not None else {}
+        if merged is None:
+            merged = self.merge_strands()
+
+        (
+            self.chrom_ranges,
+            self.merged_starts,
+            self.merged_ends,
+            self.merged_first,
+            self.merged_last,
+        ) = merged
+
+    @staticmethod
+    def get_filename(path):
+        return os.path.join(path, "compiled_annotation.bin")
+
+    def strand_intervals(self):
+        intervals = {}
+        for strand_key, (lo, hi) in self.strand_ranges.items():
+            intervals[strand_key] = (
+                self.starts[lo:hi],
+                self.ends[lo:hi],
+                np.arange(lo, hi, dtype=np.int64),
+            )
+        return intervals
+
+    def merge_strands(self):
+        """
+        Builds a strand-agnostic view of the segments. For each chrom, the
+        segments of both strands are cut at each other's boundaries into
+        non-overlapping pieces, each covered by at most one segment per strand.
+        Thus every piece carries the sense and antisense annotation together.
+        For each piece and strand we keep the row of the first segment at or
+        after the piece (merged_first) and the row of the last segment at or
+        before it (merged_last). With rows sorted by position, a block that
+        overlaps pieces lo:hi overlaps the segment rows
+        merged_first[lo]:merged_last[hi-1] + 1 of each strand, so a single
+        np.searchsorted serves both strands.
+
+        :return: (chrom_ranges, merged_starts, merged_ends, merged_first, merged_last)
+            with chrom -> (lo, hi) row-ranges into the merged arrays and
+            (n, 2) row arrays with columns in the order of STRANDS
+        """
+        chrom_ranges = OrderedDict()
+        m_starts = []
+        m_ends = []
+        m_first = []
+        m_last = []
+        n_rows = len(self.starts)
+        n = 0
+        for chrom in sorted(set([chrom for chrom, strand in self.strand_ranges])):
+            ranges = [self.strand_ranges.get((chrom, s), (0, 0)) for s in self.STRANDS]
+            bp = np.unique(
+                np.concatenate(
+                    [self.starts[lo:hi] for lo, hi in ranges]
+                    + [self.ends[lo:hi] for lo, hi in ranges]
+                ).astype(np.int64)
+            )
+            starts, ends = bp[:-1], bp[1:]
+            rows = np.full((len(starts), len(self.STRANDS)), -1, dtype=np.int64)
+            for k, (lo, hi) in enumerate(ranges):
+                # the only segment that can cover a piece is the first one
+                # ending after the piece starts
+                i = np.searchsorted(self.ends[lo:hi], starts, side="right")
+                covered = i < hi - lo
+                covered[covered] = self.starts[lo:hi][i[covered]] <= starts[covered]
+                rows[covered, k] = i[covered] + lo
+
+            keep = (rows >= 0).any(axis=1)
+            rows = rows[keep]
+            m_starts.append(starts[keep])
+            m_ends.append(ends[keep])
+            m_last.append(np.maximum.accumulate(rows, axis=0))
+            first = np.where(rows >= 0, rows, n_rows)[::-1]
+            m_first.append(np.minimum.accumulate(first, axis=0)[::-1])
+
+            chrom_ranges[chrom] = (n, n + len(rows))
+            n += len(rows)
+
+        def concat(arrays, shape):
+            if not arrays:
+                return np.zeros(shape, dtype=np.int64)
+            return np.concatenate(arrays)
+
+        return (
+            chrom_ranges,
+            concat(m_starts, 0),
+            concat(m_ends, 0),
+            concat(m_first, (0, len(self.STRANDS))),
+            concat(m_last, (0, len(self.STRANDS))),
+        )
+
+    def save(self, path, gtf=""):
+        fname = self.get_filename(path)
+        cl = self.classifications
+        arrays = OrderedDict(
+            starts=np.ascontiguousarray(self.starts, dtype=np.int64),
+            ends=np.ascontiguousarray(self.ends, dtype=np.int64),
+            cids=np.ascontiguousarray(self.cids, dtype=np.uint32),
+            cls_offsets=np.ascontiguousarray(cl.offsets, dtype=np.uint32),
+            cls_entries=np.ascontiguousarray(cl.entries, dtype=np.uint32),
+            cls_tags=np.ascontiguousarray(cl.tag_ids, dtype=np.uint32),
+            merged_starts=np.ascontiguousarray(self.merged_starts, dtype=np.int64),
+            merged_ends=np.ascontiguousarray(self.merged_ends, dtype=np.int64),
+            merged_first=np.ascontiguousarray(self.merged_first, dtype=np.int64),
+            merged_last=np.ascontiguousarray(self.merged_last, dtype=np.int64),
+        )
+        header = dict(
+            version=self.VERSION,
+            gtf=gtf_signature(gtf),
+            strands=[
+                [chrom, strand, int(lo), int(hi)]
+                for (chrom, strand), (lo, hi) in self.strand_ranges.items()
+            ],
+            chroms=[
+                [chrom, int(lo), int(hi)] for chrom, (lo, hi) in self.chrom_ranges.items()
+            ],
+            strings=cl.strings,
+            tag_strings=cl.tag_strings,
+            arrays={},
+        )
+
+        # array offsets are relative to the (aligned) end of the header
+        ofs = 0
+        for name, arr in arrays.items():
+            ofs = -(-ofs // self.ALIGN) * self.ALIGN
+            header["arrays"][name] = [arr.dtype.str, list(arr.shape), ofs]
+            ofs += arr.nbytes
+
+        hbytes = json.dumps(header).encode("utf-8")
+        data_start = self.data_start(len(hbytes))
+        # write to a temporary file next to the index and move it into place,
+        # so that concurrent readers never memory-map a half-written index
+        tmp = f"{fname}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(self.MAGIC)
+                f.write(np.uint64(len(hbytes)).tobytes())
+                f.write(hbytes)
+                for name, arr in arrays.items():
+                    f.seek(data_start + header["arrays"][name][2])
+                    f.write(arr.tobytes())
+
+            os.replace(tmp, fname)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        self.header = header
+        return fname
+
+    @classmethod
+    def data_start(cls, hlen):
+        return -(-(len(cls.MAGIC) + 8 + hlen) // cls.ALIGN) * cls.ALIGN
+
+    @staticmethod
+    def read_header(fname):
+        with open(fname, "rb") as f:
+            magic = f.read(len(CompiledIndex.MAGIC))
+            if magic != CompiledIndex.MAGIC:
+                raise ValueError(f"'{fname}' is not a compiled annotation index")
+
+            hlen = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(hlen).decode("utf-8"))
+            header["data_start"] = CompiledIndex.data_start(hlen)
+            return header
+
+    @classmethod
+    def load(cls, path):
+        fname = cls.get_filename(path)
+        header = cls.read_header(fname)
+        if header["version"] != cls.VERSION:
+            raise ValueError(
+                f"compiled annotation index '{fname}' has version {header['version']}, "
+                f"expected {cls.VERSION}. Please re-compile."
+            )
+
+        arrays = {}
+        for name, (dtype, shape, ofs) in header["arrays"].items():
+            if np.prod(shape) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    fname,
+                    dtype=dtype,
+                    mode="r",
+                    offset=header["data_start"] + ofs,
+                    shape=tuple(shape),
+                )
+
+        strand_ranges = OrderedDict()
+        for chrom, strand, lo, hi in header["strands"]:
+            strand_ranges[(chrom, strand)] = (lo, hi)
+
+        chrom_ranges = OrderedDict()
+        for chrom, lo, hi in header["chroms"]:
+            chrom_ranges[chrom] = (lo, hi)
+
+        classifications = InternedClassifications(
+            header["strings"],
+            arrays["cls_offsets"],
+            arrays["cls_entries"],
+            header["tag_strings"],
+            arrays["cls_tags"],
+        )
+        # plain ndarray views are much faster to slice than memmap objects
+        merged = (chrom_ranges,) + tuple(
+            np.asarray(arrays[name])
+            for name in ["merged_starts", "merged_ends", "merged_first", "merged_last"]
+        )
+        return cls(
+            strand_ranges,
+            arrays["starts"],
+            arrays["ends"],
+            arrays["cids"],
+            classifications,
+            merged=merged,
+            header=header,
+        )
+
+    @staticmethod
+    def is_current(path, gtf):
+        """
+        True if the compiled index at <path> was built from <gtf>. Compares
+        size and mtime first and only falls back to the md5 checksum if those
+        differ (e.g. because the GTF was copied).
+        """
+        if not CompiledClassifier.files_exist(path):
+            return False
+
+        header = CompiledIndex.read_header(CompiledIndex.get_filename(path))
+        if header.get("version") != CompiledIndex.VERSION:
+            return False
+
+        ref = header.get("gtf", {})
+        if not gtf or not ref:
+            # nothing to compare against
+            return True
+
+        st = os.stat(gtf)
+        if st.st_size != ref["size"]:
+            return False
+
+        if st.st_mtime_ns == ref["mtime"]:
+            return True
+
+        return gtf_signature(gtf)["md5"] == ref["md5"]
+
+
 ## Helper functions for working with NCLS
 def query(nc, x0, x1):
     """
@@ -204,12 +730,12 @@ def query(nc, x0, x1):
     return frozenset((o[2] for o in nc.find_overlap(x0, x1)))
 
 
-def decompose(nc):
+def decompose(starts, ends, ids):
     """
-    Iterate over the unique start or end coordinates of all the intervals
-    in a NCLS, essentially decomposing the original NCLS into non-overlapping
+    Sweep over the sorted start and end coordinates of all the intervals
+    of one strand, essentially decomposing them into non-overlapping
     segments of unique target_id combinations.
-    This is used to *compile* an NCLS. Compiled, here means that target_ids
+    This is used to *compile* an annotation. Compiled, here means that target_ids
     reference not original GTF features, but enumerated, unique combinations of
     the GTF features as they are positioned and potentially overlap in the
     reference sequence.
@@ -217,43 +743,227 @@ def decompose(nc):
     tagging information only once, and that this processing can be done prior
     to any tagging, reducing the complexity to a simple array lookup with O(1).
 
-    :param nc: The NCLS (nested list) with original genomic features from GTF
-    :type nc: NCLS64
+    Every start and end coordinate is an event that adds or removes a
+    feature from the multiset of active features. Events are sorted once
+    and the combination active between two consecutive event positions is
+    emitted whenever it changes, so the whole strand is processed in
+    O(N log N) without any interval queries.
+    Active features are kept by their rank in (start, -end) order, which is
+    the order in which NCLS reports overlaps. Building the frozensets in
+    that order keeps their iteration order, and thus the order of the
+    joined annotation tags, the same as for uncompiled lookups.
+
+    :param starts: start coordinates (0-based, inclusive) of the features
+    :param ends: end coordinates (exclusive) of the features
+    :param ids: target_ids of the features
     :yield: (start, end, frozenset(target_ids) )
     :rtype: None
     """
     logger = logging.getLogger("compile")
     logger.info(f"compiling strand into non-overlapping and pre-classified annotations")
 
-    starts, ends, ids = np.array(nc.intervals()).T
-    logger.debug(f"retrieved {len(starts)} intervals from ncls")
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    ids = np.asarray(ids)
+    # empty intervals never overlap anything
+    mask = ends > starts
+    starts, ends, ids = starts[mask], ends[mask], ids[mask]
+    logger.debug(f"sweeping over {len(starts)} intervals")
+    if not len(starts):
+        return
+
+    # rank features the way NCLS orders them
+    order = np.lexsort((-ends, starts))
+    ranked_ids = ids[order].tolist()
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
 
-    breakpoints = np.array(sorted(set(starts) | set(ends)))
+    pos = np.concatenate([starts, ends])
+    events = np.argsort(pos, kind="stable")
+    pos = pos[events]
+    is_start = (events < len(starts)).tolist()
+    event_ranks = np.concatenate([rank, rank])[events].tolist()
+
+    breakpoints, first = np.unique(pos, return_index=True)
     logger.debug(f"identified {len(breakpoints)} breakpoints")
+    bounds = first.tolist() + [len(pos)]
+
+    active = {}
+    last_pos = None
+    last_key = frozenset()
+    for k, bp in enumerate(breakpoints.tolist()):
+        for j in range(bounds[k], bounds[k + 1]):
+            r = event_ranks[j]
+            count = active.get(r, 0) + (1 if is_start[j] else -1)
+            if count:
+                active[r] = count
+            else:
+                del active[r]
+
+        key = frozenset([ranked_ids[r] for r in sorted(active)])
+        if key != last_key:
+            if last_key:
+                # ensure we do not yield the empty set
+                yield last_pos, bp, last_key
+            last_key = key
+            last_pos = bp
+
+
+class AnnotationMetrics:
+    """
+    Throughput and classification statistics of GenomeAnnotation.annotate_BAM().
+    Lookups are counted by the path they took: a direct array lookup of a single
+    pre-classified combination (fast_path), CompiledClassifier.joiner() for
+    reads that overlap several segments (joiner), no overlapping annotation at
+    all (no_hit) or an uncompiled NCLS lookup (ncls). With --antisense, each
+    read contributes two lookups.
+    Annotation time is attributed to chromosomes in proportion to the number of
+    reads of each chunk that map there.
+
+    Records are written as JSON-lines (one per progress interval and a final
+    one that includes per-chromosome numbers) or, if the file name ends in
+    .prom, as a Prometheus textfile that is replaced atomically each time.
+    """
 
-    if not len(starts):
-        return
+    lookups = ["fast_path", "joiner", "no_hit", "ncls"]
 
-    # since we sorted, the first must be a start position
-    last_pos = breakpoints[0]
-    last_key = query(nc, last_pos, last_pos + 1)
-    for bp in breakpoints[1:]:
-        # depending on wether this is another start or
-        # end position, the transition point can be off by one nt
-        # in either direction. Most robust fix was to scan all 3
-        # options until the key changes (while ensuring that end > start)
-        for x in [-1, 0, +1]:
-            if bp + x <= last_pos:
-                continue
-
-            key = query(nc, bp + x, bp + x + 1)
-            if key != last_key:
-                if len(last_key):
-                    # ensure we do not yield the empty set
-                    yield last_pos, bp + x, last_key
-                last_key = key
-                last_pos = bp + x
-                break
+    def __init__(self, fname=""):
+        self.fname = fname
+        self.n_written = 0
+        self.counts = defaultdict(int)
+        self.chrom_reads = defaultdict(int)
+        self.chrom_seconds = defaultdict(float)
+
+    def add_chunk(self, chroms, dt):
+        n = len(chroms)
+        for chrom, n_chrom in Counter(chroms).items():
+            self.chrom_reads[chrom] += n_chrom
+            self.chrom_seconds[chrom] += dt * n_chrom / n
+
+    def pop(self):
+        """
+        Return the statistics gathered so far as plain dicts and start over.
+        Used by parallel workers to ship their numbers to the main process.
+        """
+        data = (dict(self.counts), dict(self.chrom_reads), dict(self.chrom_seconds))
+        self.counts.clear()
+        self.chrom_reads.clear()
+        self.chrom_seconds.clear()
+        return data
+
+    def merge(self, data):
+        counts, chrom_reads, chrom_seconds = data
+        for k, v in counts.items():
+            self.counts[k] += v
+        for k, v in chrom_reads.items():
+            self.chrom_reads[k] += v
+        for k, v in chrom_seconds.items():
+            self.chrom_seconds[k] += v
+
+    def record(self, n_reads, dt, final=False, **kw):
+        c = self.counts
+        n_lookups = max(sum([c[k] for k in self.lookups]), 1)
+        rec = dict(
+            time=time(),
+            final=final,
+            reads=n_reads,
+            elapsed_seconds=dt,
+            reads_per_second=n_reads / max(dt, 1e-6),
+            unmapped=c["unmapped"],
+            intergenic_fraction=c["intergenic"] / max(n_reads - c["unmapped"], 1),
+        )
+        for k in self.lookups:
+            rec[f"{k}_fraction"] = c[k] / n_lookups
+
+        rec.update(kw)
+        if final:
+            rec["chroms"] = {
+                chrom: dict(
+                    reads=self.chrom_reads[chrom],
+                    seconds=self.chrom_seconds[chrom],
+                    reads_per_second=self.chrom_reads[chrom]
+                    / max(self.chrom_seconds[chrom], 1e-6),
+                )
+                for chrom in sorted(self.chrom_reads)
+            }
+
+        return rec
+
+    def write(self, n_reads, dt, final=False, **kw):
+        if not self.fname:
+            return
+
+        if self.fname.endswith(".prom"):
+            tmp = self.fname + ".tmp"
+            with open(tmp, "wt") as f:
+                f.write(self.format_prometheus(n_reads, dt, **kw))
+            os.replace(tmp, self.fname)
+        else:
+            rec = self.record(n_reads, dt, final=final, **kw)
+            with open(self.fname, "at" if self.n_written else "wt") as f:
+                f.write(json.dumps(rec) + "\n")
+
+        self.n_written += 1
+
+    def format_prometheus(self, n_reads, dt, **kw):
+        def label(value):
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+            return value.replace("\n", "\\n")
+
+        prefix = "spacemake_annotator"
+        lines = []
+
+        def metric(name, kind, help, values):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in values:
+                lines.append(f"{prefix}_{name}{labels} {value}")
+
+        metric("reads_total", "counter", "alignments processed", [("", n_reads)])
+        metric("elapsed_seconds", "gauge", "time spent annotating", [("", dt)])
+        metric(
+            "reads_per_second",
+            "gauge",
+            "average throughput",
+            [("", n_reads / max(dt, 1e-6))],
+        )
+        metric(
+            "unmapped_reads_total",
+            "counter",
+            "unmapped alignments",
+            [("", self.counts["unmapped"])],
+        )
+        metric(
+            "intergenic_reads_total",
+            "counter",
+            "mapped alignments without any annotation (gF:INTERGENIC)",
+            [("", self.counts["intergenic"])],
+        )
+        metric(
+            "lookups_total",
+            "counter",
+            "annotation lookups by code path",
+            [(f'{{path="{k}"}}', self.counts[k]) for k in self.lookups],
+        )
+        for k, v in kw.items():
+            metric(k, "gauge", k.replace("_", " "), [("", float(v))])
+
+        metric(
+            "chrom_reads_total",
+            "counter",
+            "mapped alignments per chromosome",
+            [(f'{{chrom="{label(c)}"}}', n) for c, n in sorted(self.chrom_reads.items())],
+        )
+        metric(
+            "chrom_seconds_total",
+            "counter",
+            "annotation time per chromosome",
+            [
+                (f'{{chrom="{label(c)}"}}', t)
+                for c, t in sorted(self.chrom_seconds.items())
+            ],
+        )
+        return "\n".join(lines) + "\n"
 
 
 class GenomeAnnotation:
@@ -263,86 +973,122 @@ class GenomeAnnotation:
 
     logger = logging.getLogger("GenomeAnnotation")
 
-    def __init__(self, df, processor, is_compiled=False):
+    def __init__(self, strand_intervals, processor, is_compiled=False):
         """
         [summary]
 
-        :param df: Annotation data of either raw GTF features or pre-classified combinations
-        :type df: DataFrame with at least the following columns: chrom, strand, start, end
-        :param processor: evaluates indices into df and returns annotation
-            the indices point into the dataframe to all
-            overlapping features
+        :param strand_intervals: Annotation data of either raw GTF features or pre-classified combinations
+        :type strand_intervals: dict (chrom, strand) -> (starts, ends, indices) arrays
+        :param processor: evaluates indices and returns annotation
+            the indices point to all overlapping features
         :type processor: function that takes frozenset(indices) as sole argument
         """
-        # self.df = df
         self.processor = processor
-
-        # find all unique combinations of chrom + strand
-        strands = df[["chrom", "strand"]].drop_duplicates().values
-        self.strand_keys = [tuple(s) for s in strands]
+        self.strand_intervals = strand_intervals
+        self.strand_keys = sorted(strand_intervals.keys())
+        # nested lists are only built when a strand is first queried
         self.strand_map = {}
         self.empty = frozenset([])
+        self.is_compiled = is_compiled
+        self.classifier = None
+        self.load_time = 0
+        self.metrics = AnnotationMetrics()
 
-        t0 = time()
-        for strand_key in sorted(self.strand_keys):
-            chrom, strand = strand_key
+    @staticmethod
+    def intervals_from_df(df):
+        """
+        Splits a DataFrame with at least the columns chrom, strand, start, end
+        into (starts, ends, indices) arrays for each (chrom, strand)
+        """
+        strand_intervals = OrderedDict()
+        for strand_key, d in df.groupby(["chrom", "strand"], sort=True, observed=True):
+            strand_intervals[tuple(strand_key)] = (
+                d["start"].values,
+                d["end"].values,
+                d.index.values,
+            )
+
+        return strand_intervals
+
+    def get_nested_list(self, strand_key):
+        nested_list = self.strand_map.get(strand_key, None)
+        if nested_list is None:
+            if not strand_key in self.strand_intervals:
+                return None
 
-            d = df.query(f"chrom == '{chrom}' and strand == '{strand}'")
-            nested_list = ncls.NCLS(d["start"], d["end"], d.index)
+            t0 = time()
+            starts, ends, idx = self.strand_intervals[strand_key]
+            nested_list = ncls.NCLS(
+                np.asarray(starts, dtype=np.int64),
+                np.asarray(ends, dtype=np.int64),
+                np.asarray(idx, dtype=np.int64),
+            )
             self.strand_map[strand_key] = nested_list
+            dt = time() - t0
+            self.logger.debug(
+                f"constructed nested list of {len(starts)} features on {strand_key} in {dt:.3f}s"
+            )
 
-        dt = time() - t0
-        self.logger.info(
-            f"constructed nested lists of {len(df)} features on {len(self.strand_keys)} strands in {dt:.3f}s"
-        )
-        self.is_compiled = is_compiled
+        return nested_list
 
     @classmethod
     def from_compiled_index(cls, path):
-        cdf_path, cclass_path = CompiledClassifier.get_filenames(path)
         t0 = time()
-        cdf = pd.read_csv(cdf_path, sep="\t")
-        classifications = np.load(cclass_path, allow_pickle=True)
+        index = CompiledIndex.load(path)
         dt = time() - t0
         cls.logger.info(
-            f"re-read compiled annotation index with {len(cdf)} original GTF feature combinations and {len(classifications)} in {dt:.3f} seconds"
+            f"loaded compiled annotation index with {len(index.cids)} original GTF feature combinations and {len(index.classifications)} classifications in {dt:.3f} seconds"
         )
+        ga = cls.from_index(index)
+        ga.load_time = dt
+        return ga
+
+    @classmethod
+    def from_index(cls, index):
         ## Create a secondary Annotator which uses the non-overlapping combinations
         ## and the pre-classified annotations for the actual tagging
-        cl = CompiledClassifier(cdf, classifications)
-        gc = cls(cdf, lambda idx: cl.process(idx), is_compiled=True)
+        cl = CompiledClassifier(index.cids, index.classifications)
+        gc = cls(index.strand_intervals(), lambda idx: cl.process(idx), is_compiled=True)
+        gc.index = index
+        gc.classifier = cl
         return gc
 
     @classmethod
-    def from_GTF(cls, gtf, df_cache=""):
+    def from_GTF(cls, gtf, df_cache="", cache_size=100000):
         # load GTF the first time. Need to build compiled annotation
         t0 = time()
         df = load_GTF(gtf)
         dt = time() - t0
         cls.logger.info(f"loaded {len(df)} GTF records in {dt:.3f} seconds")
         if df_cache:
-            df.to_csv(df_cache, sep="\t")
+            try:
+                store_table(df, df_cache)
+            except ImportError as err:
+                cls.logger.warning(f"unable to store tabular cache '{df_cache}': {err}")
 
         ## Build NCLS with original GTF features
-        cl = GTFClassifier(df)
-        ga = cls(df, lambda idx: cl.process(idx))
+        cl = GTFClassifier(df, cache_size=cache_size)
+        ga = cls(cls.intervals_from_df(df), lambda idx: cl.process(idx))
+        ga.classifier = cl
+        ga.load_time = time() - t0
         return ga
 
     @classmethod
-    def from_uncompiled_df(cls, path):
+    def from_uncompiled_df(cls, path, cache_size=100000):
         t0 = time()
-        df = pd.read_csv(path, sep="\t")
+        df = load_table(path)
         dt = time() - t0
         cls.logger.info(f"loaded {len(df)} tabular records in {dt:.3f} seconds")
 
         ## Build NCLS with original GTF features
-        cl = GTFClassifier(df)
-        ga = cls(df, lambda idx: cl.process(idx))
+        cl = GTFClassifier(df, cache_size=cache_size)
+        ga = cls(cls.intervals_from_df(df), lambda idx: cl.process(idx))
+        ga.classifier = cl
+        ga.load_time = time() - t0
         return ga
 
     def sanity_check(self, df):
-        for strand, nc in self.strand_map.items():
-            starts, ends, idx = np.array(nc.intervals()).T
+        for strand, (starts, ends, idx) in self.strand_intervals.items():
             self.logger.debug(
                 f"checking {strand} with starts from {starts.min()}-{starts.max()} and idx from {idx.min()}-{idx.max()}"
             )
@@ -350,11 +1096,10 @@ class GenomeAnnotation:
             assert idx.max() < len(df)
 
     def query_idx(self, chrom, start, end, strand):
-        strand_key = (chrom, strand)
-        if not strand_key in self.strand_map:
+        nested_list = self.get_nested_list((chrom, strand))
+        if nested_list is None:
             return self.empty
 
-        nested_list = self.strand_map[strand_key]
         return query(nested_list, start, end)
 
     def query_idx_blocks(self, chrom, strand, blocks):
@@ -371,9 +1116,154 @@ class GenomeAnnotation:
         idx = self.query_idx_blocks(chrom, strand, blocks)
         return self.processor(idx)
 
-    def compile(self, path=""):
-        chroms = []
-        strands = []
+    def query_chrom_batch(self, chrom, starts, ends):
+        """
+        Vectorized lookup of many alignment blocks at once, against both strands
+        in one go. Requires a compiled GenomeAnnotation, where the segments of
+        each strand are sorted and non-overlapping and merged into a
+        strand-agnostic index (see CompiledIndex.merge_strands()). The overlapping
+        pieces are found with np.searchsorted over the piece boundaries instead
+        of one NCLS query per block and strand.
+
+        :param starts: start coordinates of the blocks
+        :param ends: end coordinates of the blocks (exclusive)
+        :return: (lo, hi) arrays of index rows with shape (n, 2), one column per
+            strand in the order of CompiledIndex.STRANDS. Block i overlaps the
+            segments lo[i, k]:hi[i, k] of strand k (none if lo[i, k] == hi[i, k])
+            and their cids are self.classifier.cid_table[lo[i, k]:hi[i, k]]
+        """
+        assert self.is_compiled
+        index = self.index
+        lo = np.zeros((len(starts), len(index.STRANDS)), dtype=np.int64)
+        hi = np.zeros((len(starts), len(index.STRANDS)), dtype=np.int64)
+        c0, c1 = index.chrom_ranges.get(chrom, (0, 0))
+        if c0 == c1:
+            return lo, hi
+
+        # first piece that ends after the block starts
+        p_lo = np.searchsorted(index.merged_ends[c0:c1], starts, side="right") + c0
+        # first piece that starts at or after the block end
+        p_hi = np.searchsorted(index.merged_starts[c0:c1], ends, side="left") + c0
+        hit = p_hi > p_lo
+        lo[hit] = index.merged_first[p_lo[hit]]
+        hi[hit] = index.merged_last[p_hi[hit] - 1] + 1
+        return lo, np.maximum(lo, hi)
+
+    def query_blocks_batch(self, chrom, strand, starts, ends):
+        """
+        Like query_chrom_batch(), but only for the segments of one strand.
+
+        :return: (lo, hi) arrays of index rows. Block i overlaps segments lo[i]:hi[i]
+            (none if lo[i] == hi[i]) and their cids are self.classifier.cid_table[lo[i]:hi[i]]
+        """
+        if strand not in self.index.STRANDS:
+            lo = np.zeros(len(starts), dtype=np.int64)
+            return lo, lo
+
+        k = self.index.STRANDS.index(strand)
+        lo, hi = self.query_chrom_batch(chrom, starts, ends)
+        return lo[:, k], hi[:, k]
+
+    def classify_reads(self, blocks, chroms, strands, antisense=False):
+        """
+        Classify a chunk of mapped reads at once, using query_chrom_batch().
+        A single lookup per block yields the overlapping segments of both strands,
+        so the antisense annotation comes at little extra cost.
+
+        :param blocks: aligned blocks of each read (as from read.get_blocks())
+        :param chroms: chrom of each read
+        :param strands: strand to annotate against for each read
+        :param antisense: also classify against the opposite strands
+        :return: (sense, antisense) lists as returned by resolve_hits(), one entry
+            for each read. antisense is None unless requested.
+        """
+        # gather all blocks, remembering which read they came from
+        keys = {}
+        read_keys = [keys.setdefault(chrom, len(keys)) for chrom in chroms]
+        n_blocks = np.array([len(b) for b in blocks], dtype=np.int64)
+        block_ofs = np.zeros(len(blocks) + 1, dtype=np.int64)
+        np.cumsum(n_blocks, out=block_ofs[1:])
+
+        coords = np.array(
+            list(itertools.chain.from_iterable(blocks)), dtype=np.int64
+        ).reshape(-1, 2)
+        block_key = np.repeat(np.array(read_keys, dtype=np.int64), n_blocks)
+        lo = np.zeros((len(coords), len(CompiledIndex.STRANDS)), dtype=np.int64)
+        hi = np.zeros((len(coords), len(CompiledIndex.STRANDS)), dtype=np.int64)
+        for chrom, k in keys.items():
+            mask = block_key == k
+            lo[mask], hi[mask] = self.query_chrom_batch(
+                chrom, coords[mask, 0], coords[mask, 1]
+            )
+
+        # column of the strand to annotate against, for each block
+        col = np.repeat(
+            np.array([CompiledIndex.STRANDS.index(s) for s in strands], dtype=np.int64),
+            n_blocks,
+        )
+        rows = np.arange(len(coords))
+        sense = self.resolve_hits(lo[rows, col], hi[rows, col], n_blocks, block_ofs)
+        anti = None
+        if antisense:
+            col = 1 - col
+            anti = self.resolve_hits(lo[rows, col], hi[rows, col], n_blocks, block_ofs)
+
+        return sense, anti
+
+    def resolve_hits(self, lo, hi, n_blocks, block_ofs):
+        """
+        Reduce block-level lookup results to one classification per read.
+        Reads that overlap only a single segment (the vast majority) are resolved
+        by a direct array lookup. All others fall back to the processor, exactly
+        as query_blocks() would.
+
+        :param lo: first overlapping index row of each block
+        :param hi: end of the overlapping index rows of each block
+        :param n_blocks: number of blocks of each read
+        :param block_ofs: offset of the first block of each read (and the total)
+        :return: list with one entry per read: the cid of the pre-classified
+            combination (fast path), None if there is no overlap, or a
+            (gf, gn, gs, gt) tuple from the processor for reads overlapping
+            multiple segments
+        """
+        n_reads = len(n_blocks)
+        read_i = np.repeat(np.arange(n_reads), n_blocks)
+        n_hits = np.bincount(read_i, weights=hi - lo, minlength=n_reads)
+        hit = hi > lo
+        row_min = np.full(n_reads, np.iinfo(np.int64).max, dtype=np.int64)
+        row_max = np.full(n_reads, -1, dtype=np.int64)
+        np.minimum.at(row_min, read_i[hit], lo[hit])
+        np.maximum.at(row_max, read_i[hit], hi[hit] - 1)
+
+        single = (n_hits > 0) & (row_min == row_max)
+        cids = self.classifier.cid_table[np.where(single, row_min, 0)]
+        n_single = int(single.sum())
+        n_no_hit = int((n_hits == 0).sum())
+        self.metrics.counts["fast_path"] += n_single
+        self.metrics.counts["no_hit"] += n_no_hit
+        self.metrics.counts["joiner"] += n_reads - n_single - n_no_hit
+
+        results = []
+        for i, (is_single, n, cid) in enumerate(
+            zip(single.tolist(), n_hits.tolist(), cids.tolist())
+        ):
+            if is_single:
+                results.append(cid)
+            elif n == 0:
+                results.append(None)
+            else:
+                # rare: read overlaps multiple segments
+                # union the blocks one by one, like query_idx_blocks did
+                rows = set()
+                for j in range(block_ofs[i], block_ofs[i + 1]):
+                    rows |= frozenset(range(lo[j], hi[j]))
+                results.append(self.processor(frozenset(rows)))
+
+        return results
+
+    def compile(self, path="", gtf=""):
+        t_start = time()
+        strand_ranges = OrderedDict()
         cstarts = []
         cends = []
         cids = []
@@ -381,25 +1271,32 @@ class GenomeAnnotation:
         cid_lkup = {}
 
         t0 = time()
-        for strand_key, nc in self.strand_map.items():
-            chrom, strand = strand_key
-            self.logger.info(f"decomposing {chrom} {strand}")
-            for start, end, idx in decompose(nc):
-                # print(f"start={start} end={end} idx={idx}")
-                chroms.append(chrom)
-                strands.append(strand)
-                cstarts.append(start)
-                cends.append(end)
-                if idx not in cid_lkup:
-                    cid_lkup[idx] = len(cid_lkup)
-                    cidx.append(idx)
-
-                cids.append(cid_lkup[idx])
+        # the sweep creates a frozenset per segment and keeps the unique ones
+        # alive. Pause the cyclic garbage collector, which would otherwise
+        # re-scan them over and over again.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for strand_key in self.strand_keys:
+                chrom, strand = strand_key
+                self.logger.info(f"decomposing {chrom} {strand}")
+                lo = len(cids)
+                for start, end, idx in decompose(*self.strand_intervals[strand_key]):
+                    # print(f"start={start} end={end} idx={idx}")
+                    cstarts.append(start)
+                    cends.append(end)
+                    if idx not in cid_lkup:
+                        cid_lkup[idx] = len(cid_lkup)
+                        cidx.append(idx)
+
+                    cids.append(cid_lkup[idx])
+
+                strand_ranges[strand_key] = (lo, len(cids))
+        finally:
+            if gc_enabled:
+                gc.enable()
 
         self.logger.info("done")
-        cdf = pd.DataFrame(
-            dict(chrom=chroms, strand=strands, start=cstarts, end=cends, cid=cids)
-        )
         dt = time() - t0
         self.logger.debug(f"decomposed original GTF annotation in {dt:.3f} seconds")
 
@@ -410,76 +1307,354 @@ class GenomeAnnotation:
             res = self.processor(idx)
             classifications.append(res)
 
-        ## Turn into np.array to turn lookup into super-fast array index operation
-        classifications = np.array(classifications, dtype=object)
+        ## Intern all strings and turn into arrays to turn lookup into super-fast array index operation
+        classifications = InternedClassifications.from_classifications(classifications)
         dt = time() - t0
         self.logger.debug(
-            f"pre-classified {n} feature combinations in {dt:.3f} seconds"
+            f"pre-classified {len(cidx)} feature combinations in {dt:.3f} seconds"
         )
 
+        index = CompiledIndex(
+            strand_ranges,
+            np.array(cstarts, dtype=np.int64),
+            np.array(cends, dtype=np.int64),
+            np.array(cids, dtype=np.uint32),
+            classifications,
+        )
         if path:
-            cdf_path, cclass_path = CompiledClassifier.get_filenames(path)
-            ## Store the compiled DataFrame and pre-classifications
+            ## Store the compiled index in a single binary file
             t0 = time()
-            cdf.to_csv(cdf_path, sep="\t", index=False)
-            np.save(cclass_path, classifications)
+            os.makedirs(path, exist_ok=True)
+            fname = index.save(path, gtf=gtf)
             dt = time() - t0
-            self.logger.debug(f"stored compiled annotation index in {dt:.3f} seconds")
+            self.logger.debug(
+                f"stored compiled annotation index in '{fname}' in {dt:.3f} seconds"
+            )
 
-        ## Create a secondary Annotator which uses the non-overlapping combinations
-        ## and the pre-classified annotations for the actual tagging
-        cl = CompiledClassifier(cdf, classifications)
-        gc = GenomeAnnotation(cdf, lambda idx: cl.process(idx), is_compiled=True)
+        ga = GenomeAnnotation.from_index(index)
+        # for the metrics, compiling is part of getting the index ready
+        ga.load_time = self.load_time + time() - t_start
+        return ga
 
-        return gc
+    @staticmethod
+    def get_queries(reads, ref_names):
+        """
+        Extracts the information needed for annotation from a chunk of reads.
+        These are small, picklable tuples that can be sent to worker processes.
 
-    def annotate_BAM(self, src, out, antisense=False, interval=5):
-        import pysam
+        :param ref_names: list of reference names, indexed by read.tid
+        :return: list of (chrom, strand, blocks) tuples, or None for unmapped reads
+        """
+        return [
+            None
+            if read.is_unmapped
+            else (
+                ref_names[read.tid],
+                "-" if read.is_reverse else "+",
+                read.get_blocks(),
+            )
+            for read in reads
+        ]
+
+    @staticmethod
+    def make_tags(gf, gn, gs, gt):
+        if len(gf):
+            return [
+                ("gF", ",".join(gf)),
+                ("gN", ",".join(gn)),
+                ("gS", ",".join(gs)),
+                ("gT", ",".join(gt)),
+            ]
+        else:
+            return [("gF", "INTERGENIC")]
 
+    def render_tags(self, mapped, sense, anti, results):
+        """
+        Turn the output of classify_reads() into BAM tags. Reads resolved by the
+        fast path (and pairs of them with --antisense) use the pre-rendered tags
+        of the compiled index, so no strings are joined for them.
+
+        :param mapped: positions in results of the classified reads
+        :param sense: classify_reads() results for the alignment strand
+        :param anti: classify_reads() results for the opposite strand, or None
+        :param results: list to place the tags in
+        """
+        cl = self.classifier.classifications
+        empty = ([], [], [], [])
+
+        def classification(res):
+            if res is None:
+                return empty
+            if res.__class__ is int:
+                return cl[res]
+            return res
+
+        if anti is None:
+            for i, res in zip(mapped, sense):
+                if res.__class__ is int:
+                    results[i] = cl.tags(res)
+                elif res is None:
+                    results[i] = cl.intergenic
+                else:
+                    results[i] = self.make_tags(*res)
+        else:
+            for i, res, res_as in zip(mapped, sense, anti):
+                if res.__class__ is not tuple and res_as.__class__ is not tuple:
+                    results[i] = cl.pair_tags(res, res_as)
+                else:
+                    # rare: at least one side needed the joiner
+                    results[i] = self.make_tags(
+                        *[
+                            a + b
+                            for a, b in zip(classification(res), classification(res_as))
+                        ]
+                    )
+
+    def annotate_queries(self, queries, antisense=False):
+        """
+        Annotate a chunk of reads, as described by get_queries().
+
+        :return: list of BAM tags to add to each read, or None for unmapped reads
+        """
+        t0 = time()
         as_strand = {"+": "-", "-": "+"}
+        results = [None] * len(queries)
+        mapped = [i for i, q in enumerate(queries) if q is not None]
+        chroms = [queries[i][0] for i in mapped]
+        strands = [queries[i][1] for i in mapped]
+        blocks = [queries[i][2] for i in mapped]
+
+        if self.is_compiled:
+            sense, anti = self.classify_reads(
+                blocks, chroms, strands, antisense=antisense
+            )
+            self.render_tags(mapped, sense, anti, results)
+        else:
+            sense = [
+                self.query_blocks(chrom, strand, b)
+                for chrom, strand, b in zip(chroms, strands, blocks)
+            ]
+            if antisense:
+                anti = [
+                    self.query_blocks(chrom, as_strand[strand], b)
+                    for chrom, strand, b in zip(chroms, strands, blocks)
+                ]
+            self.metrics.counts["ncls"] += len(blocks) * (2 if antisense else 1)
+
+            if antisense:
+                for i, (gf, gn, gs, gt), (gf_as, gn_as, gs_as, gt_as) in zip(
+                    mapped, sense, anti
+                ):
+                    results[i] = self.make_tags(
+                        gf + gf_as, gn + gn_as, gs + gs_as, gt + gt_as
+                    )
+            else:
+                for i, res in zip(mapped, sense):
+                    results[i] = self.make_tags(*res)
+
+        counts = self.metrics.counts
+        counts["unmapped"] += len(queries) - len(mapped)
+        # make_tags() returns a single tag only for INTERGENIC
+        counts["intergenic"] += sum([len(results[i]) == 1 for i in mapped])
+        if mapped:
+            self.metrics.add_chunk(chroms, time() - t0)
+
+        return results
+
+    def annotate_BAM(
+        self,
+        src,
+        out,
+        antisense=False,
+        interval=5,
+        chunk_size=10000,
+        parallel=1,
+        metrics_out="",
+    ):
+        import pysam
+        from spacemake.parallel import chunkify
+
         self.logger.info(
-            f"beginning BAM annotation: {src} -> {out}. is_compiled={self.is_compiled}"
+            f"beginning BAM annotation: {src} -> {out}. is_compiled={self.is_compiled} parallel={parallel}"
         )
+        self.metrics = AnnotationMetrics(metrics_out)
         bam = pysam.AlignmentFile(src)
         out = pysam.AlignmentFile(out, "wbu", template=bam)
+        ref_names = bam.references
+        chunks = chunkify(bam.fetch(until_eof=True), n_chunk=chunk_size)
+        if parallel > 1:
+            tagged = self.annotate_chunks_parallel(
+                chunks, ref_names, antisense=antisense, n_workers=parallel
+            )
+        else:
+            tagged = (
+                (
+                    reads,
+                    self.annotate_queries(
+                        self.get_queries(reads, ref_names), antisense=antisense
+                    ),
+                )
+                for n_chunk, reads in chunks
+            )
+
         t0 = time()
         T = interval
-        for n, read in enumerate(bam.fetch(until_eof=True)):
-            if not read.is_unmapped:
-                chrom = bam.get_reference_name(read.tid)
-                strand = "-" if read.is_reverse else "+"
-
-                gf, gn, gs, gt = self.query_blocks(chrom, strand, read.get_blocks())
-                if antisense:
-                    gf_as, gn_as, gs_as, gt_as = self.query_blocks(
-                        chrom, as_strand[strand], read.get_blocks()
-                    )
-                    gf += gf_as
-                    gn += gn_as
-                    gs += gs_as
-                    gt += gt_as
-
-                if len(gf):
-                    read.tags += [
-                        ("gF", ",".join(gf)),
-                        ("gN", ",".join(gn)),
-                        ("gS", ",".join(gs)),
-                        ("gT", ",".join(gt)),
-                    ]
-                else:
-                    read.tags += [("gF", "INTERGENIC")]
-
-            out.write(read)
+        n = 0
+        dt = 0
+        for reads, tags in tagged:
+            for read, read_tags in zip(reads, tags):
+                if read_tags is not None:
+                    # set_tag() appends to the raw aux data. read.tags += ...
+                    # would decode and re-encode all existing tags of every read
+                    for tag, value in read_tags:
+                        read.set_tag(tag, value, "Z")
+
+                out.write(read)
+
+            n += len(reads)
             dt = time() - t0
             if dt > T:
                 self.logger.info(
                     f"processed {n} alignments in {dt:.2f} seconds ({n/dt:.2f} reads/second)"
                 )
+                self.metrics.write(n, dt, index_load_seconds=self.load_time)
                 T += interval
 
         self.logger.info(
-            f"processed {n} alignments in {dt:.2f} seconds ({n/dt:.2f} reads/second)"
+            f"processed {n} alignments in {dt:.2f} seconds ({n/max(dt, 1e-6):.2f} reads/second)"
         )
+        self.metrics.write(n, dt, final=True, index_load_seconds=self.load_time)
+        if parallel <= 1:
+            # workers report their own cache statistics
+            self.log_cache_stats()
+
+    def log_cache_stats(self):
+        """
+        Report hits and misses of the classification cache (uncompiled path only).
+        """
+        cl = self.classifier
+        if not getattr(cl, "cache_size", 0):
+            return
+
+        n = cl.cache_hits + cl.cache_misses
+        self.logger.info(
+            f"classification cache: {cl.cache_hits} hits, {cl.cache_misses} misses "
+            f"({100.0 * cl.cache_hits / max(n, 1):.2f}% hit rate, "
+            f"{len(cl.cache)}/{cl.cache_size} entries)"
+        )
+
+    def annotate_chunks_parallel(
+        self, chunks, ref_names, antisense=False, n_workers=4, max_pending=None
+    ):
+        """
+        Fans the annotation of chunks of reads out to worker processes and
+        yields (reads, tags) in the original order of the chunks.
+        The reads themselves never leave this process, only the lightweight
+        queries and the resulting tags are sent through queues. Thus the output is
+        identical to the serial code path.
+        The workers are forked and share this GenomeAnnotation, including a
+        memory-mapped compiled index.
+        """
+        import heapq
+        import multiprocessing as mp
+        from spacemake.parallel import (
+            put_or_abort,
+            join_with_empty_queues,
+            log_qerr,
+        )
+
+        if max_pending is None:
+            max_pending = 4 * n_workers
+
+        # Qres is unbounded, memory is limited by max_pending instead.
+        # This way, workers can never block while we wait to place more work in Qin
+        Qin = mp.Queue()
+        Qres = mp.Queue()
+        Qerr = mp.Queue()
+        abort_flag = mp.Value("b")
+        abort_flag.value = False
+
+        workers = []
+        for i in range(n_workers):
+            w = mp.Process(
+                target=annotation_worker,
+                name=f"annotation_worker_{i}",
+                args=(self, Qin, Qres, antisense, Qerr, abort_flag),
+            )
+            w.start()
+            workers.append(w)
+
+        pending = {}
+        heap = []
+        n_chunk_needed = 0
+
+        def collect():
+            # block until the next result arrives, then yield all chunks
+            # that are ready, in order
+            nonlocal n_chunk_needed
+            import queue
+
+            while not abort_flag.value:
+                try:
+                    n_chunk, tags, metrics = Qres.get(timeout=1)
+                except queue.Empty:
+                    if any([w.exitcode for w in workers]):
+                        # a worker died w/o being able to raise the flag
+                        abort_flag.value = True
+                    continue
+
+                self.metrics.merge(metrics)
+                heapq.heappush(heap, (n_chunk, tags))
+                break
+
+            while heap and (heap[0][0] == n_chunk_needed):
+                n_chunk, tags = heapq.heappop(heap)
+                yield pending.pop(n_chunk), tags
+                n_chunk_needed += 1
+
+        try:
+            for n_chunk, reads in chunks:
+                pending[n_chunk] = reads
+                queries = self.get_queries(reads, ref_names)
+                if put_or_abort(Qin, (n_chunk, queries), abort_flag):
+                    break
+
+                while len(pending) >= max_pending and not abort_flag.value:
+                    yield from collect()
+
+            while pending and not abort_flag.value:
+                yield from collect()
+
+        except BaseException:
+            # the consumer closed the generator early, or raised. Results may
+            # still be pending in Qres and keep the workers from exiting,
+            # unless join_with_empty_queues() drains them.
+            abort_flag.value = True
+            raise
+
+        finally:
+            # signal all workers to finish
+            for w in workers:
+                Qin.put(None)
+
+            for w in workers:
+                qres, qerr = join_with_empty_queues(w, [Qres, Qerr], abort_flag)
+                if qerr:
+                    log_qerr(qerr)
+
+        if abort_flag.value:
+            raise RuntimeError("an annotation worker failed. Aborting.")
+
+
+def annotation_worker(ga, Qin, Qres, antisense, Qerr, abort_flag):
+    from spacemake.parallel import queue_iter, ExceptionLogging
+
+    with ExceptionLogging("annotation_worker", Qerr=Qerr, exc_flag=abort_flag):
+        for n_chunk, queries in queue_iter(Qin, abort_flag):
+            tags = ga.annotate_queries(queries, antisense=antisense)
+            Qres.put((n_chunk, tags, ga.metrics.pop()))
+
+        ga.log_cache_stats()
 
 
 if __name__ == "__main__":
@@ -492,7 +1667,11 @@ if __name__ == "__main__":
     parser.add_argument(
         "--tabular",
         default="",
-        help="path to tabular version of the relevant features only (e.g. gencodev38.tsv)",
+        help=(
+            "path to tabular version of the relevant features only (e.g. gencodev38.tsv). "
+            "Use a .feather or .parquet extension for a binary cache that loads much "
+            "faster (requires pyarrow)"
+        ),
     )
     parser.add_argument(
         "--compiled",
@@ -517,6 +1696,25 @@ if __name__ == "__main__":
         help="emulate dropseqtools behavior",
     )
 
+    parser.add_argument(
+        "--parallel",
+        default=1,
+        type=int,
+        help="number of worker processes for annotation (default=1, no extra processes)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        default=100000,
+        type=int,
+        help="number of feature combinations to keep in the LRU cache of classifications "
+        "when not using the compiled annotation (default=100000, 0 disables the cache)",
+    )
+    parser.add_argument(
+        "--metrics-out",
+        default="",
+        help="write throughput and classification metrics here. JSON-lines, or a "
+        "Prometheus textfile if the name ends in .prom",
+    )
     parser.add_argument("--bam-in", help="path for the input BAM to be tagged")
     parser.add_argument(
         "--bam-out",
@@ -524,17 +1722,27 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
 
-    if CompiledClassifier.files_exist(args.compiled) and args.use_compiled:
+    if args.use_compiled and CompiledIndex.is_current(args.compiled, args.gtf):
         ga = GenomeAnnotation.from_compiled_index(args.compiled)
 
-    elif args.tabular and os.access(args.tabular, os.R_OK):
-        ga = GenomeAnnotation.from_uncompiled_df(args.tabular)
+    elif table_is_current(args.tabular, args.gtf):
+        ga = GenomeAnnotation.from_uncompiled_df(
+            args.tabular, cache_size=args.cache_size
+        )
 
     else:
-        ga = GenomeAnnotation.from_GTF(args.gtf, df_cache=args.tabular)
+        ga = GenomeAnnotation.from_GTF(
+            args.gtf, df_cache=args.tabular, cache_size=args.cache_size
+        )
 
     # perform compilation if that's what we want
     if not ga.is_compiled and args.use_compiled:
-        ga = ga.compile(args.compiled)
-
-    ga.annotate_BAM(args.bam_in, args.bam_out, antisense=args.antisense)
+        ga = ga.compile(args.compiled, gtf=args.gtf)
+
+    ga.annotate_BAM(
+        args.bam_in,
+        args.bam_out,
+        antisense=args.antisense,
+        parallel=args.parallel,
+        metrics_out=args.metrics_out,
+    )
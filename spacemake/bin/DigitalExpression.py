@@ -0,0 +1,235 @@
+import logging
+import numpy as np
+
+
+def parse_args():
+    from spacemake.util import make_minimal_parser
+
+    parser = make_minimal_parser("DigitalExpression")
+
+    parser.add_argument("--input", default="/dev/stdin")
+    parser.add_argument(
+        "--output", required=True, help="where to write the sparse DGE (.h5ad)"
+    )
+    parser.add_argument(
+        "--summary",
+        default="",
+        help="optional per cell summary in the format of DropSeq DigitalExpression",
+    )
+    parser.add_argument(
+        "--cell-bc-file",
+        required=True,
+        help="file with one cell barcode per line. Only these cells are counted",
+    )
+    parser.add_argument("--cell-barcode-tag", default="CB")
+    parser.add_argument("--umi-tag", default="MI")
+    parser.add_argument("--gene-name-tag", default="gn")
+    parser.add_argument("--gene-strand-tag", default="gs")
+    parser.add_argument("--gene-function-tag", default="gf")
+    parser.add_argument(
+        "--locus-function",
+        nargs="+",
+        default=["CODING", "UTR"],
+        help="gene functions that are counted (default=CODING UTR)",
+    )
+    parser.add_argument(
+        "--strand-strategy",
+        default="SENSE",
+        choices=["SENSE", "ANTISENSE", "BOTH"],
+        help="which read strand, relative to the gene, is counted (default=SENSE)",
+    )
+    parser.add_argument(
+        "--read-mq",
+        default=10,
+        type=int,
+        help="minimum mapping quality of a read to be counted (default=10)",
+    )
+    parser.add_argument(
+        "--edit-distance",
+        default=1,
+        type=int,
+        choices=[0, 1],
+        help="collapse UMIs within this hamming distance per cell and gene (default=1)",
+    )
+    parser.add_argument(
+        "--output-reads-instead",
+        default=False,
+        action="store_true",
+        help="count reads instead of UMIs",
+    )
+
+    return parser.parse_args()
+
+
+# same precedence as DropSeq: exonic beats intronic beats intergenic
+FUNCTION_PRIORITY = {"CODING": 0, "UTR": 0, "INTRONIC": 1, "INTERGENIC": 2}
+
+
+class GeneAssigner:
+    """
+    Resolves the gene tags of a read to at most one gene, the way DropSeq
+    DigitalExpression does: genes on the wrong strand are dropped, every
+    gene keeps only its most exonic function, and of the genes with the
+    overall best function only those with an accepted function are kept.
+    Reads that end up with zero or more than one gene are not counted.
+    Results are cached, because the same tag combinations repeat a lot.
+    """
+
+    def __init__(self, locus_function=["CODING", "UTR"], strand_strategy="SENSE"):
+        self.locus_function = set(locus_function)
+        self.strand_strategy = strand_strategy
+        self.cache = {}
+
+    def strand_ok(self, gene_strand, is_reverse):
+        if self.strand_strategy == "BOTH":
+            return True
+
+        sense = (gene_strand == "-") == is_reverse
+        return sense if self.strand_strategy == "SENSE" else not sense
+
+    def assign(self, gn, gs, gf, is_reverse):
+        key = (gn, gs, gf, is_reverse)
+        gene = self.cache.get(key, False)
+        if gene is False:
+            gene = self._assign(*key)
+            self.cache[key] = gene
+
+        return gene
+
+    def _assign(self, gn, gs, gf, is_reverse):
+        if not gn or not gs or not gf:
+            return None
+
+        best = {}
+        for name, strand, func in zip(gn.split(","), gs.split(","), gf.split(",")):
+            if not self.strand_ok(strand, is_reverse):
+                continue
+
+            prio = FUNCTION_PRIORITY.get(func, len(FUNCTION_PRIORITY))
+            if prio < best.get(name, (prio + 1,))[0]:
+                best[name] = (prio, func)
+
+        if not best:
+            return None
+
+        top = min(prio for prio, func in best.values())
+        genes = [
+            name
+            for name, (prio, func) in best.items()
+            if prio == top and func in self.locus_function
+        ]
+        if len(genes) != 1:
+            return None
+
+        return genes[0]
+
+
+def count_reads(args, barcodes, stats):
+    import pysam
+    from spacemake.quant import ArrayDGE, get_tag
+
+    whitelist = set(barcodes)
+    assigner = GeneAssigner(args.locus_function, args.strand_strategy)
+    dge = ArrayDGE()
+
+    bam = pysam.AlignmentFile(args.input, check_sq=False)
+    for aln in bam.fetch(until_eof=True):
+        stats["n_records"] += 1
+        if aln.is_unmapped or aln.is_secondary or aln.is_supplementary:
+            stats["n_not_primary"] += 1
+            continue
+
+        if aln.mapping_quality < args.read_mq:
+            stats["n_low_mq"] += 1
+            continue
+
+        cell = get_tag(aln, args.cell_barcode_tag)
+        if cell not in whitelist:
+            stats["n_cell_not_selected"] += 1
+            continue
+
+        gene = assigner.assign(
+            get_tag(aln, args.gene_name_tag),
+            get_tag(aln, args.gene_strand_tag),
+            get_tag(aln, args.gene_function_tag),
+            aln.is_reverse,
+        )
+        if gene is None:
+            stats["n_no_gene"] += 1
+            continue
+
+        umi = get_tag(aln, args.umi_tag)
+        if umi is None:
+            stats["n_no_umi"] += 1
+            continue
+
+        stats["n_counted"] += 1
+        dge.add_read(gene=gene, cell=cell, umi=umi)
+
+    return dge
+
+
+def write_summary(fname, args, barcodes, umis, n_reads):
+    import datetime
+
+    n_umi = np.asarray(umis.sum(axis=1)).ravel()
+    n_genes = np.asarray((umis > 0).sum(axis=1)).ravel()
+    with open(fname, "wt") as f:
+        # 7 lines before the first record, like the DropSeq metrics files
+        f.write("## htsjdk.samtools.metrics.StringHeader\n")
+        f.write(f"# spacemake DigitalExpression INPUT={args.input}\n")
+        f.write("## htsjdk.samtools.metrics.StringHeader\n")
+        f.write(f"# Started on: {datetime.datetime.now().ctime()}\n")
+        f.write("\n")
+        f.write(
+            "## METRICS CLASS\t"
+            "org.broadinstitute.dropseqrna.barnyard.DigitalExpressionSummary\n"
+        )
+        f.write("CELL_BARCODE\tNUM_GENIC_READS\tNUM_TRANSCRIPTS\tNUM_GENES\n")
+        for i in np.argsort(-n_reads, kind="stable"):
+            f.write(f"{barcodes[i]}\t{n_reads[i]}\t{n_umi[i]}\t{n_genes[i]}\n")
+
+
+def main(args):
+    from collections import defaultdict
+    from spacemake.preprocess.dge import sparse_dge_to_adata
+
+    logger = logging.getLogger("spacemake.bin.DigitalExpression")
+    barcodes = [line.strip() for line in open(args.cell_bc_file) if line.strip()]
+    logger.info(f"counting {len(barcodes)} cell barcodes from {args.cell_bc_file}")
+
+    stats = defaultdict(int)
+    dge = count_reads(args, barcodes, stats)
+    logger.info(f"read stats: {dict(stats)}")
+
+    if args.edit_distance:
+        dge.collapse_umis()
+
+    adata = dge.make_DGEs()
+    # keep the order of the cell barcode file, omitting cells without reads
+    obs = set(adata.obs_names)
+    adata = adata[[bc for bc in barcodes if bc in obs]]
+    reads = adata.layers[f"reads_{dge.main_channel}"]
+    n_reads = np.asarray(reads.sum(axis=1)).ravel().astype(np.int64)
+    X = reads if args.output_reads_instead else adata.X
+    if X.sum() == 0:
+        # still write an (empty) DGE and summary, so downstream rules can run
+        logger.warning(f"The DGE from {args.input} is empty")
+
+    out = sparse_dge_to_adata(
+        X, list(adata.obs_names), list(adata.var_names), n_reads=n_reads
+    )
+    if args.summary:
+        write_summary(args.summary, args, list(adata.obs_names), adata.X, n_reads)
+
+    logger.info(f"writing {out.shape[0]} cells x {out.shape[1]} genes to {args.output}")
+    out.write(args.output)
+    return out
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    import spacemake.util as util
+
+    util.setup_logging(args)
+    main(args)
@@ -78,7 +78,7 @@ species_reference_annotation_compiled = (
     "species_data/{species}/{ref_name}/compiled_annotation"
 )
 species_reference_annotation_compiled_target = (
-    "species_data/{species}/{ref_name}/compiled_annotation/non_overlapping.csv"
+    "species_data/{species}/{ref_name}/compiled_annotation/compiled_annotation.bin"
 )
 
 #########################
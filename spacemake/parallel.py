@@ -70,6 +70,8 @@ def join_with_empty_queues(proc, Qs, abort_flag, timeout=1):
     to terminate properly.
     """
 
+    import queue
+
     def drain(Q):
         content = []
         while not Q.empty():
@@ -110,6 +112,26 @@ def chunkify(src, n_chunk=1000):
         yield n, chunk
 
 
+def pack_chunk(items, sep="\0"):
+    """
+    Serializes a list of equally sized tuples of strings into a single bytes
+    buffer (fields separated by NUL, which does not occur in FASTQ or SAM
+    text). Passing that through a multiprocessing.Queue costs little more
+    than one memcpy, instead of pickling and unpickling every single string.
+    """
+    from itertools import chain
+
+    n_fields = len(items[0]) if items else 0
+    return sep.join(chain([str(n_fields)], chain.from_iterable(items))).encode()
+
+
+def unpack_chunk(buf, sep="\0"):
+    "inverse of pack_chunk(). Returns a list of tuples of strings"
+    fields = buf.decode().split(sep)
+    it = iter(fields[1:])
+    return list(zip(*[it] * int(fields[0])))
+
+
 def log_qerr(qerr):
     "helper function for reporting errors in sub processes"
     for name, lines in qerr:
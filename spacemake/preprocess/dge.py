@@ -42,67 +42,99 @@ def calculate_adata_metrics(adata, dge_summary_path=None, n_reads=None):
         adata.obs["reads_per_counts"] = adata.obs.n_reads / adata.obs.total_counts
 
 
-def calculate_shannon_entropy_scompression(adata):
-    import math
-    import itertools
+def barcodes_to_matrix(barcodes):
+    """
+    Encodes barcodes as a (n_barcodes x max_length) uint8 matrix of ASCII
+    codes, shorter barcodes are padded with 0.
+    """
     import numpy as np
-    from collections import Counter
 
-    def compute_shannon_entropy(barcode):
-        prob, length = Counter(barcode), float(len(barcode))
-        return -sum(
-            count / length * math.log(count / length, 2) for count in prob.values()
-        )
+    barcodes = np.asarray(barcodes, dtype="S")
+    L = max(barcodes.dtype.itemsize, 1)
+    return barcodes.view(np.uint8).reshape(len(barcodes), L)
 
-    def compute_string_compression(barcode):
-        compressed_barcode = "".join(
-            letter + str(len(list(group)))
-            for letter, group in itertools.groupby(barcode)
-        )
 
-        return len(compressed_barcode)
+def compute_shannon_entropy(M):
+    """
+    Shannon entropy (in bits) of the letter frequencies of each row of a
+    barcode matrix from barcodes_to_matrix().
+    """
+    import numpy as np
+
+    length = (M > 0).sum(axis=1)
+    entropy = np.zeros(len(M))
+    for letter in np.unique(M[M > 0]):
+        count = (M == letter).sum(axis=1)
+        # rows without this letter contribute 0 * log(0) = 0
+        p = count / np.maximum(length, 1)
+        entropy -= np.where(count > 0, p * np.log2(np.where(count > 0, p, 1)), 0)
+
+    return entropy
+
+
+def compute_string_compression(M):
+    """
+    Length of the run-length encoding (letter followed by run length, e.g.
+    'AAAC' -> 'A3C1') of each row of a barcode matrix from barcodes_to_matrix().
+    """
+    import numpy as np
+
+    n, L = M.shape
+    valid = M > 0
+    # a run starts at the first letter and wherever the letter changes
+    starts = valid.copy()
+    starts[:, 1:] &= M[:, 1:] != M[:, :-1]
+
+    row, col = np.nonzero(starts)
+    if not len(row):
+        return np.zeros(n, dtype=np.int64)
 
-    bc = adata.obs.index.to_numpy()
-    bc_len = len(bc[0])
+    # a run ends where the next run of the same row starts, or at the row end
+    end = np.append(col[1:], 0)
+    last = np.append(row[1:] != row[:-1], True)
+    end[last] = valid.sum(axis=1)[row[last]]
+    run_length = end - col
+
+    n_digits = np.floor(np.log10(run_length)).astype(np.int64) + 1
+    return np.bincount(row, weights=1 + n_digits, minlength=n).astype(np.int64)
+
+
+def calculate_shannon_entropy_scompression(adata):
+    import numpy as np
+
+    bc = barcodes_to_matrix(adata.obs.index.to_numpy())
+    bc_len = len(adata.obs.index[0]) if adata.n_obs else 0
     theoretical_barcodes = np.random.choice(
-        ["A", "C", "T", "G"], size=(bc.shape[0], bc_len)
+        np.frombuffer(b"ACTG", dtype=np.uint8), size=(bc.shape[0], bc_len)
     )
 
-    adata.obs["exact_entropy"] = np.round(
-        np.array([compute_shannon_entropy(cell_bc) for cell_bc in bc]), 2
-    )
+    adata.obs["exact_entropy"] = np.round(compute_shannon_entropy(bc), 2)
     adata.obs["theoretical_entropy"] = np.round(
-        np.array(
-            [compute_shannon_entropy(cell_bc) for cell_bc in theoretical_barcodes]
-        ),
-        2,
-    )
-    adata.obs["exact_compression"] = np.round(
-        np.array([compute_string_compression(cell_bc) for cell_bc in bc]), 2
+        compute_shannon_entropy(theoretical_barcodes), 2
     )
+    adata.obs["exact_compression"] = np.round(compute_string_compression(bc), 2)
     adata.obs["theoretical_compression"] = np.round(
-        np.array(
-            [compute_string_compression(cell_bc) for cell_bc in theoretical_barcodes]
-        ),
-        2,
+        compute_string_compression(theoretical_barcodes), 2
     )
 
 
 def dge_to_sparse_adata(dge_path, dge_summary_path):
-    import anndata
     import numpy as np
     import gzip
-    import pandas as pd
-    from scipy.sparse import coo_matrix, hstack
+    from array import array
+    from scipy.sparse import coo_matrix
 
     gene_names = []
+    # non-zero entries are collected in growable arrays and turned into a
+    # sparse matrix once at the end, so loading is linear in the file size
+    rows = array("q")
+    data = array("i")
+    nnz = []
 
     with gzip.open(dge_path, "rt") as dge:
         first_line = dge.readline().strip().split("\t")
-        has_mt = False
         barcodes = first_line[1:]
         N_bc = len(barcodes)
-        X = None
 
         # read DGE line by line
         # first row: contains CELL BARCODEs
@@ -113,54 +145,69 @@ def dge_to_sparse_adata(dge_path, dge_summary_path):
             _gene_name = vals[:_idx_tab]
             gene_names.append(_gene_name)
 
-            if _gene_name.lower().startswith("mt-"):
-                has_mt = True
-                
             # store counts as np.array
             _vals = np.fromstring(vals[_idx_tab:], dtype=np.int32, count=N_bc, sep='\t').flatten()
-            _idx_nonzero = np.argwhere(_vals != 0).flatten()
-
-            if len(_idx_nonzero) > 0:
-                gene_sp = coo_matrix((_vals[_idx_nonzero].astype(np.int32), (_idx_nonzero, np.zeros(len(_idx_nonzero)))), shape=(N_bc, 1), dtype=np.int32)
-            else:
-                gene_sp = coo_matrix((N_bc, 1), dtype=np.int32)
-
-            if X is None:
-                 X = gene_sp
-            else:
-                 X = hstack([X, gene_sp])
-
-        if X is None:
-            X = coo_matrix((len(barcodes), 0), dtype=np.int32)
-    
-        if not has_mt:
-            # ensure we have an entry for mitochondrial transcripts even if it's just all zeros
-            print(
-                "need to add mt-missing because no mitochondrial stuff was among the genes for annotation"
-            )
-            gene_names.append("mt-missing")
-            X = hstack([X, np.zeros(X.shape[0])[:, None]])
-
-        X = X.tocsr()
-        X = X.astype(np.float32)
-        adata = anndata.AnnData(
-            X, obs=pd.DataFrame(index=barcodes), var=pd.DataFrame(index=gene_names)
+            _idx_nonzero = np.flatnonzero(_vals)
+
+            rows.frombytes(_idx_nonzero.astype(np.int64).tobytes())
+            data.frombytes(_vals[_idx_nonzero].astype(np.int32).tobytes())
+            nnz.append(len(_idx_nonzero))
+
+        cols = np.repeat(np.arange(len(gene_names)), nnz)
+        X = coo_matrix(
+            (
+                np.frombuffer(data, dtype=np.int32),
+                (np.frombuffer(rows, dtype=np.int64), cols),
+            ),
+            shape=(N_bc, len(gene_names)),
+            dtype=np.int32,
+        ).tocsr()
+
+        adata = sparse_dge_to_adata(
+            X, barcodes, gene_names, dge_summary_path=dge_summary_path
         )
+        if adata.X.sum() == 0:
+            logger.warn(f"The DGE from {dge_path} is empty")
 
-        # name the index
-        adata.obs.index.name = "cell_bc"
+        return adata
 
-        # attach metrics such as: total_counts, pct_mt_counts, etc
-        # also attach n_genes, and calculate pcr
-        calculate_adata_metrics(adata, dge_summary_path)
 
-        # calculate per shannon_entropy and string_compression per bead
-        calculate_shannon_entropy_scompression(adata)
+def sparse_dge_to_adata(X, barcodes, gene_names, dge_summary_path=None, n_reads=None):
+    """
+    Turns a sparse (cells x genes) count matrix into the AnnData object that
+    spacemake works with: float32 CSR counts, an all-zero 'mt-missing' gene if
+    there are no mitochondrial genes, per cell metrics and barcode entropy.
+    """
+    import anndata
+    import numpy as np
+    import pandas as pd
+    from scipy.sparse import csr_matrix, hstack
 
-        if adata.X.sum() == 0:
-            logger.warn(f"The DGE from {dge_path} is empty")
+    gene_names = list(gene_names)
+    if not any(name.lower().startswith("mt-") for name in gene_names):
+        # ensure we have an entry for mitochondrial transcripts even if it's just all zeros
+        print(
+            "need to add mt-missing because no mitochondrial stuff was among the genes for annotation"
+        )
+        gene_names.append("mt-missing")
+        X = hstack([X, csr_matrix((X.shape[0], 1))])
 
-        return adata
+    X = csr_matrix(X, dtype=np.float32)
+    adata = anndata.AnnData(
+        X, obs=pd.DataFrame(index=barcodes), var=pd.DataFrame(index=gene_names)
+    )
+
+    # name the index
+    adata.obs.index.name = "cell_bc"
+
+    # attach metrics such as: total_counts, pct_mt_counts, etc
+    # also attach n_genes, and calculate pcr
+    calculate_adata_metrics(adata, dge_summary_path, n_reads=n_reads)
+
+    # calculate per shannon_entropy and string_compression per bead
+    calculate_shannon_entropy_scompression(adata)
+
+    return adata
 
 
 def load_external_dge(dge_path):
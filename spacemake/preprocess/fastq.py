@@ -14,7 +14,7 @@ import pandas as pd
 import numpy as np
 import pysam
 import multiprocessing as mp
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 #from Bio import pairwise2
 from Bio import SeqIO
 
@@ -23,6 +23,8 @@ from spacemake.parallel import (
     queue_iter,
     join_with_empty_queues,
     chunkify,
+    pack_chunk,
+    unpack_chunk,
     ExceptionLogging,
 )
 from spacemake.util import read_fq
@@ -64,6 +66,36 @@ def hamming(seqA, seqB, costs, match=2):
     return score
 
 
+def hamming_matrix(Q, R, costs, match=2):
+    """
+    Vectorized hamming(): scores all queries against all references at once.
+    Q and R are uint8 matrices of ASCII codes of the same width (queries and
+    references, one per row), costs is the position-specific mismatch cost.
+    Returns a (len(Q), len(R)) matrix of scores.
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    # the BC2 start position tweak of hamming()
+    bonus = (Q == ord("A")) & (costs == 0)
+    # a mismatch scores -cost (+1 bonus). Start from all mismatches and add
+    # the difference for every matching position
+    base = bonus.sum(axis=1) - costs.sum()
+    weights = match + costs - bonus
+    scores = np.empty((len(Q), len(R)))
+    # limit the (queries x references x positions) temporary to ~16MB
+    chunk = max(1, (1 << 24) // max(1, R.size))
+    for i in range(0, len(Q), chunk):
+        eq = Q[i : i + chunk, np.newaxis, :] == R[np.newaxis, :, :]
+        scores[i : i + chunk] = np.einsum("qrl,ql->qr", eq, weights[i : i + chunk])
+
+    return scores + base[:, np.newaxis]
+
+
+def seqs_to_matrix(seqs, L):
+    "encodes sequences (truncated to L nt) as a uint8 matrix of ASCII codes"
+    seqs = np.array([s[:L] for s in seqs], dtype=f"S{max(L, 1)}")
+    return seqs.view(np.uint8).reshape(len(seqs), max(L, 1))[:, :L]
+
+
 class BarcodeMatcher:
     def __init__(self, fname, length_specific=True, place="left"):
         self.logger = logging.getLogger("BarcodeMatcher")
@@ -73,14 +105,18 @@ class BarcodeMatcher:
         if len(self.names) == 0:
             self.logger.warning(f"no references loaded! Disabling matching for {fname}")
             self.align = self.align_na
+            self.align_batch = self.align_batch_na
         else:
             self.lmin = self.slen.min()
             self.lmax = self.slen.max()
             self.place = place
             self.costs = {}
             self.slen_masks = {}
+            # reference sequences of each length as uint8 matrix for hamming_matrix()
+            self.seq_matrices = {}
             for l in range(self.lmin, self.lmax + 1):
                 self.slen_masks[l] = (self.slen == l).nonzero()[0]
+                self.seq_matrices[l] = seqs_to_matrix(self.seqs[self.slen_masks[l]], l)
                 cost = np.ones(l)
                 if place == "left":
                     cost[-8:] = 2
@@ -115,9 +151,32 @@ class BarcodeMatcher:
             [-1],
         )
 
+    def align_batch_na(self, queries):
+        return [self.align_na(query) for query in queries]
+
+    def score_batch(self, queries, lq):
+        """
+        Scores queries (of at least lq nt) against the selected references, as
+        hamming() would. Returns the indices of the selected references and a
+        (len(queries), len(indices)) score matrix.
+        """
+        costs = self.costs[lq]
+        if self.length_specific:
+            Q = seqs_to_matrix(queries, lq)
+            return self.slen_masks[lq], hamming_matrix(Q, self.seq_matrices[lq], costs)
+
+        scores = np.empty((len(queries), len(self.seqs)))
+        for l in range(self.lmin, self.lmax + 1):
+            # like zip() in hamming(), only compare the common prefix
+            m = min(l, lq)
+            Q = seqs_to_matrix(queries, m)
+            scores[:, self.slen_masks[l]] = hamming_matrix(
+                Q, self.seq_matrices[l][:, :m], costs[:m]
+            )
+
+        return np.arange(len(self.seqs)), scores
+
     def align(self, query, debug=False):
-        results = []
-        scores = []
         # select set of barcode sequences to align with
         if len(query) < self.lmin:
             return (
@@ -126,66 +185,137 @@ class BarcodeMatcher:
                 [-1],
             )
 
-        if self.length_specific:
-            lq = min(len(query), self.lmax)
-            lmask = self.slen_masks[lq]
-            seqs_sel = self.seqs[lmask]
-            names_sel = self.names[lmask]
-        else:
-            seqs_sel = self.seqs
-            names_sel = self.names
-
-        costs = self.costs[lq]
-        # perform the alignments and keep results
-        for seq in seqs_sel:
-            res = hamming(query, seq, costs)
-            # print(query, seq, res)
-            results.append(res)
-            scores.append(res)
+        lq = min(len(query), self.lmax)
+        sel, scores = self.score_batch([query], lq)
+        scores = scores[0]
+        seqs_sel = self.seqs[sel]
+        names_sel = self.names[sel]
 
         # identify best alignments and return tied, best barcode matches
-        scores = np.array(scores)
         if debug:
             I = scores.argsort()[::-1]
             print("Q  ", query)
             for i in I:
                 seq = seqs_sel[i]
-                res = results[i]
+                res = scores[i]
                 print("*  ", seq, res)
 
         i = scores.argmax()
         ties = scores == scores[i]
         return names_sel[ties], seqs_sel[ties], scores[ties]
 
+    def align_batch(self, queries):
+        """
+        Same as [self.align(q) for q in queries], but queries of the same
+        length are scored together.
+        """
+        results = [None] * len(queries)
+        by_length = defaultdict(list)
+        for i, query in enumerate(queries):
+            if len(query) < self.lmin:
+                results[i] = self.align_na(query)
+            else:
+                by_length[min(len(query), self.lmax)].append(i)
+
+        for lq, idx in by_length.items():
+            sel, scores = self.score_batch([queries[i] for i in idx], lq)
+            best = scores.max(axis=1)
+            for i, row, S in zip(idx, scores, best):
+                ties = sel[row == S]
+                results[i] = self.names[ties], self.seqs[ties], row[row == S]
+
+        return results
+
 
 class TieBreaker:
-    def __init__(self, fname, place="left"):
+    def __init__(self, fname, place="left", neighborhood=0):
         self.logger = logging.getLogger("TieBreaker")
         self.matcher = BarcodeMatcher(fname, place=place)
         self.query_count = defaultdict(float)
         self.bc_count = defaultdict(float)
         self.cache = {}
+        # read-only, memory-mapped table of cached alignments (see load_cache)
+        self.table = None
+        # results that have not been shared with the other workers yet
+        self.delta = {}
+        self.n_synced = 0
+        self.index = {}
         self.n_hit = 0
         self.n_align = 0
+        self.n_index = 0
+        if neighborhood:
+            self.build_index(neighborhood)
+
+    @staticmethod
+    def resolve(names, seqs, scores):
+        if (len(names) == 1) or (len(set(names)) == 1):
+            # unambiguous best hit
+            return names[0], seqs[0], scores[0]
+        else:
+            # potentially do more involved resolving?
+            return (NO_CALL, NO_CALL, scores[0])
+
+    def build_index(self, max_mismatch=1, alphabet="ACGTN"):
+        """
+        Precomputes the result for every sequence within max_mismatch
+        substitutions of a reference barcode. Ambiguous neighbors map to
+        NO_CALL, just like in align(). Only the first lmax bases of a query
+        matter, so these are the keys.
+        """
+        if not len(self.matcher.names):
+            return
+
+        keys = set(self.matcher.seqs)
+        frontier = keys
+        for _ in range(max_mismatch):
+            frontier = set(
+                [
+                    seq[:i] + x + seq[i + 1 :]
+                    for seq in frontier
+                    for i in range(len(seq))
+                    for x in alphabet
+                    if x != seq[i]
+                ]
+            )
+            keys |= frontier
+
+        keys = sorted(keys)
+        for key, res in zip(keys, self.matcher.align_batch(keys)):
+            self.index[key] = self.resolve(*res)
+
+        self.logger.debug(
+            f"indexed {len(self.index)} sequences within {max_mismatch} mismatches"
+        )
 
     def align(self, query, debug=False, w=1):
         self.query_count[query] += w
         if not query in self.cache:
-            self.n_align += w
+            result = self.lookup_table(query)
+            if result is not None:
+                self.n_hit += w
+                self.cache[query] = result
+                self.bc_count[result[0]] += w
+                self.bc_count["total"] += w
+                return result
+
+            result = None
+            if self.index:
+                result = self.index.get(query[: self.matcher.lmax])
+
+            if result is not None:
+                self.n_index += w
+            else:
+                self.n_align += w
 
-            names, seqs, scores = self.matcher.align(query, debug)
-            if debug:
-                for n, s, S in zip(names, seqs, scores):
-                    print(f"{n}\t{s}\t{S}")
+                names, seqs, scores = self.matcher.align(query, debug)
+                if debug:
+                    for n, s, S in zip(names, seqs, scores):
+                        print(f"{n}\t{s}\t{S}")
 
-            if (len(names) == 1) or (len(set(names)) == 1):
-                # unambiguous best hit
-                result = names[0], seqs[0], scores[0]
-            else:
-                # potentially do more involved resolving?
-                result = (NO_CALL, NO_CALL, scores[0])
+                result = self.resolve(names, seqs, scores)
 
             self.cache[query] = result
+            self.delta[query] = result
 
         else:
             self.n_hit += w
@@ -195,6 +325,34 @@ class TieBreaker:
         self.bc_count["total"] += w
         return result
 
+    def lookup_table(self, query):
+        if self.table is None:
+            return None
+
+        keys = self.table["query"]
+        q = query.encode("ascii")
+        i = np.searchsorted(keys, q)
+        if i >= len(keys) or keys[i] != q:
+            return None
+
+        row = self.table[i]
+        return row["name"].decode("ascii"), row["seq"].decode("ascii"), row["score"]
+
+    def sync_cache(self, shared):
+        """
+        Exchanges new alignment results with the other workers through the
+        shared list (a manager.list() of dicts): picks up everything the others
+        have added since the last call and appends our own new results.
+        """
+        new = shared[self.n_synced :]
+        self.n_synced += len(new)
+        for delta in new:
+            self.cache.update(delta)
+
+        if self.delta:
+            shared.append(self.delta)
+            self.delta = {}
+
     def align_choices(self, queries, debug=False):
         w = 1.0 / len(queries)
         results = [self.align(q, debug=debug, w=w) for q in queries]
@@ -210,28 +368,93 @@ class TieBreaker:
         self.logger.debug(f"pre-populating alignment cache from '{fname}'")
         if fname:
             try:
-                df = pd.read_csv(
-                    fname,
-                    sep="\t",
-                    index_col=None,
-                    names=["query", "seq", "name", "score", "count"],
-                )
+                self.table = load_cache_table(fname)
+                if self.table is None:
+                    self.cache.update(read_cache_tsv(fname))
             except OSError as err:
                 self.logger.warning(f"error while loading caches: {err}")
-            else:
-                for row in df.itertuples():
-                    self.cache[row.query] = (row.name, row.seq, row.score)
 
-        self.logger.debug(f"loaded {len(self.cache)} queries.")
+        n_table = 0 if self.table is None else len(self.table)
+        self.logger.debug(f"loaded {len(self.cache) + n_table} queries.")
+
+
+def load_cache_table(fname):
+    """
+    Memory-maps an alignment cache written by store_cache(). All workers
+    share the same pages. Returns None if fname is not in this binary format.
+    """
+    with open(fname, "rb") as f:
+        if f.read(len(np.lib.format.MAGIC_PREFIX)) != np.lib.format.MAGIC_PREFIX:
+            return None
+
+    return np.load(fname, mmap_mode="r")
+
+
+def read_cache_tsv(fname):
+    "reads the plain-text alignment cache of older versions"
+    cache = {}
+    df = pd.read_csv(
+        fname,
+        sep="\t",
+        index_col=None,
+        names=["query", "seq", "name", "score", "count"],
+    )
+    for row in df.itertuples():
+        cache[row.query] = (row.name, row.seq, row.score)
+
+    return cache
+
+
+def read_cache(fname):
+    "all entries of an alignment cache file (either format) as a dict, for merging"
+    if not (fname and os.path.exists(fname)):
+        return {}
+
+    table = load_cache_table(fname)
+    if table is None:
+        return read_cache_tsv(fname)
+
+    cache = {}
+    for row in table:
+        cache[row["query"].decode("ascii")] = (
+            row["name"].decode("ascii"),
+            row["seq"].decode("ascii"),
+            row["score"],
+        )
+
+    return cache
 
 
 def store_cache(fname, cache, query_count, mincount=2):
-    with open(fname, "w") as f:
-        print(cache.keys())
-        for query in sorted(cache.keys()):
-            if query_count[query] >= mincount:
-                name, seq, score = cache[query]
-                f.write(f"{query}\t{seq}\t{name}\t{score}\t{query_count[query]}\n")
+    """
+    Stores all cached alignments of queries seen at least mincount times as
+    a numpy structured array (.npy format), sorted by query, so that
+    load_cache_table() can memory-map it and look up queries by bisection.
+    """
+    queries = [q for q in sorted(cache.keys()) if query_count[q] >= mincount]
+    names, seqs, scores = zip(*[cache[q] for q in queries]) if queries else ([], [], [])
+
+    def width(values):
+        return max([len(v) for v in values] + [1])
+
+    table = np.empty(
+        len(queries),
+        dtype=[
+            ("query", f"S{width(queries)}"),
+            ("name", f"S{width(names)}"),
+            ("seq", f"S{width(seqs)}"),
+            ("score", np.float64),
+            ("count", np.float64),
+        ],
+    )
+    table["query"] = queries
+    table["name"] = names
+    table["seq"] = seqs
+    table["score"] = scores
+    table["count"] = [query_count[q] for q in queries]
+    # write via file object, np.save() would otherwise append '.npy' to fname
+    with open(fname, "wb") as f:
+        np.save(f, table)
 
 
 def report_stats(N, prefix=""):
@@ -290,6 +513,76 @@ def match_BC2(bc2_matcher, seq, qend, tend, N, threshold=0.5):
     return bc2, BC2, ref2, score2
 
 
+# same fields as the alignments returned by Bio.pairwise2
+LocalAlignment = namedtuple("LocalAlignment", ["seqA", "seqB", "score", "start", "end"])
+
+# match, mismatch, open & extend gap (in both sequences), as used for pairwise2
+OPSEQ_SCORES = (2, -1.5, -3, -1, -3, -1)
+_local_aligner = None
+
+
+def local_align_pairwise2(seqA, seqB):
+    from Bio import pairwise2
+
+    results = pairwise2.align.localmd(
+        seqA, seqB, *OPSEQ_SCORES, one_alignment_only=True, score_only=False
+    )
+    return results[:1]
+
+
+def local_align_PairwiseAligner(seqA, seqB):
+    """
+    Same scoring and the same gapped, full-length representation as
+    local_align_pairwise2(), but based on the much faster
+    Bio.Align.PairwiseAligner. Among equally scoring alignments, the one that
+    is picked may differ.
+    """
+    global _local_aligner
+    if _local_aligner is None:
+        from Bio.Align import PairwiseAligner
+
+        match, mismatch, open_A, extend_A, open_B, extend_B = OPSEQ_SCORES
+        # the per-sequence gap score attributes are deprecated. Gaps cost the
+        # same in both sequences, so the common ones are all we need
+        assert (open_A, extend_A) == (open_B, extend_B)
+        _local_aligner = PairwiseAligner(
+            mode="local",
+            match_score=match,
+            mismatch_score=mismatch,
+            open_gap_score=open_A,
+            extend_gap_score=extend_A,
+        )
+
+    alignments = _local_aligner.align(seqA, seqB)
+    score = alignments.score
+    if score <= 0:
+        return []
+
+    coords = alignments[0].coordinates
+    a0, b0 = coords[:, 0]
+    a1, b1 = coords[:, -1]
+    # unaligned prefixes end in the same column, suffixes start in the same column
+    L = max(a0, b0)
+    A = [seqA[:a0].rjust(L, "-")]
+    B = [seqB[:b0].rjust(L, "-")]
+    for (ia, ib), (ja, jb) in zip(coords.T[:-1], coords.T[1:]):
+        A.append(seqA[ia:ja] if ja > ia else "-" * (jb - ib))
+        B.append(seqB[ib:jb] if jb > ib else "-" * (ja - ia))
+
+    end = len("".join(A))
+    L = max(len(seqA) - a1, len(seqB) - b1)
+    A.append(seqA[a1:].ljust(L, "-"))
+    B.append(seqB[b1:].ljust(L, "-"))
+
+    return [LocalAlignment("".join(A), "".join(B), score, int(max(a0, b0)), end)]
+
+
+LOCAL_ALIGNERS = {
+    "PairwiseAligner": local_align_PairwiseAligner,
+    "pairwise2": local_align_pairwise2,
+}
+
+
 def opseq_local_align(
     seq,
     opseq="GAATCACGATACGTACACCAGT",
@@ -298,10 +591,9 @@ def opseq_local_align(
     max_end=22 + 12,
     allow_start_gap=False,
     allow_end_gap=False,
+    aligner="PairwiseAligner",
 ):
-    results = pairwise2.align.localmd(
-        opseq, seq, 2, -1.5, -3, -1, -3, -1, one_alignment_only=True, score_only=False
-    )
+    results = LOCAL_ALIGNERS[aligner](opseq, seq)
     tstart = 0
     tend = 0
     if len(results) < 1:
@@ -358,16 +650,17 @@ def process_ordered_results(res_queue, args, Qerr, abort_flag):
         logger = el.logger
         out = Output(args)
 
-        for n_chunk, results in queue_iter(res_queue, abort_flag):
-            heapq.heappush(heap, (n_chunk, results))
+        for n_chunk, buf in queue_iter(res_queue, abort_flag):
+            heapq.heappush(heap, (n_chunk, buf))
 
             # as long as the root of the heap is the next needed chunk
             # pass results on to storage
             while heap and (heap[0][0] == n_chunk_needed):
-                n_chunk, results = heapq.heappop(heap)  # retrieves heap[0]
-                for assigned, record in results:
+                n_chunk, buf = heapq.heappop(heap)  # retrieves heap[0]
+                # results are packed as (assigned 'A' or 'U', record) by the workers
+                for assigned, record in unpack_chunk(buf):
                     # print("record in process_ordered_results", record)
-                    out.write(assigned, record)
+                    out.write(assigned == "A", record)
                     n_rec += 1
 
                 n_chunk_needed += 1
@@ -408,9 +701,9 @@ def process_fastq(Qfq, args, Qerr, abort_flag):
     faster parallel processing, and puts these on a mp.Queue()
     """
     with ExceptionLogging("dispatcher", Qerr=Qerr, exc_flag=abort_flag) as el:
-        for chunk in chunkify(read_source(args)):
-            logging.debug(f"placing {chunk[0]} {len(chunk[1])} in queue")
-            if put_or_abort(Qfq, chunk, abort_flag):
+        for n_chunk, reads in chunkify(read_source(args)):
+            logging.debug(f"placing {n_chunk} {len(reads)} in queue")
+            if put_or_abort(Qfq, (n_chunk, pack_chunk(reads)), abort_flag):
                 el.logger.warning("shutdown flag was raised!")
                 break
 
@@ -436,15 +729,27 @@ def process_combinatorial(Qfq, Qres, args, Qerr, abort_flag, stat_lists):
         el.logger.debug(
             f"process_combinatorial starting up with Qfq={Qfq}, Qres={Qres} and args={args}"
         )
-        bc1_matcher = TieBreaker(args.bc1_ref, place="left")
-        bc2_matcher = TieBreaker(args.bc2_ref, place="right")
+        bc1_matcher = TieBreaker(
+            args.bc1_ref, place="left", neighborhood=args.bc_neighborhood
+        )
+        bc2_matcher = TieBreaker(
+            args.bc2_ref, place="right", neighborhood=args.bc_neighborhood
+        )
         bc1_matcher.load_cache(args.bc1_cache)
         bc2_matcher.load_cache(args.bc2_cache)
 
+        Ns, deltas1, deltas2, qcounts1, qcounts2, bccounts1, bccounts2 = stat_lists
+
         out = Output(args, open_files=False)
         N = defaultdict(int)
-        for n_chunk, reads in queue_iter(Qfq, abort_flag):
+        for i_chunk, (n_chunk, buf) in enumerate(queue_iter(Qfq, abort_flag)):
+            reads = unpack_chunk(buf)
             el.logger.debug(f"received chunk {n_chunk} of {len(reads)} reads")
+            if args.cache_sync and i_chunk % args.cache_sync == 0:
+                # benefit from alignments done by the other workers
+                bc1_matcher.sync_cache(deltas1)
+                bc2_matcher.sync_cache(deltas2)
+
             results = []
             for fqid, r1, fqid2, r2, qual2 in reads:
                 N["total"] += 1
@@ -465,6 +770,7 @@ def process_combinatorial(Qfq, Qres, args, Qerr, abort_flag, stat_lists):
                     opseq=args.opseq,
                     min_opseq_score=args.min_opseq_score,
                     allow_end_gap=True,  # TODO more permanent fix for this quick'n'dirty hack to get short illumina read to work
+                    aligner=args.aligner,
                 )
                 res, tstart, tend = aln
                 # print("OPSEQ", res, tstart, tend)
@@ -507,20 +813,23 @@ def process_combinatorial(Qfq, Qres, args, Qerr, abort_flag, stat_lists):
 
                 out_d["assigned"] = assigned
                 rec = out.make_record(**out_d)
-                results.append((assigned, rec))
+                results.append(("A" if assigned else "U", rec))
 
-            Qres.put((n_chunk, results))
+            Qres.put((n_chunk, pack_chunk(results)))
 
         N["BC1_cache_hit"] = bc1_matcher.n_hit
         N["BC2_cache_hit"] = bc2_matcher.n_hit
+        N["BC1_index_hit"] = bc1_matcher.n_index
+        N["BC2_index_hit"] = bc2_matcher.n_index
 
         # return our counts and observations
         # via these list proxies
         el.logger.debug("synchronizing cache and counts")
-        Ns, qcaches1, qcaches2, qcounts1, qcounts2, bccounts1, bccounts2 = stat_lists
         Ns.append(N)
-        qcaches1.append(bc1_matcher.cache)
-        qcaches2.append(bc2_matcher.cache)
+        if bc1_matcher.delta:
+            deltas1.append(bc1_matcher.delta)
+        if bc2_matcher.delta:
+            deltas2.append(bc2_matcher.delta)
         qcounts1.append(bc1_matcher.query_count)
         qcounts2.append(bc2_matcher.query_count)
         bccounts1.append(bc1_matcher.bc_count)
@@ -549,14 +858,15 @@ def main_combinatorial(args):
     manager = mp.Manager()
     abort_flag = mp.Value("b")
     abort_flag.value = False
-    qcaches1 = manager.list()
-    qcaches2 = manager.list()
+    # new alignment results, shared between workers
+    deltas1 = manager.list()
+    deltas2 = manager.list()
     qcounts1 = manager.list()
     qcounts2 = manager.list()
     bccounts1 = manager.list()
     bccounts2 = manager.list()
     Ns = manager.list()
-    stat_lists = [Ns, qcaches1, qcaches2, qcounts1, qcounts2, bccounts1, bccounts2]
+    stat_lists = [Ns, deltas1, deltas2, qcounts1, qcounts2, bccounts1, bccounts2]
 
     with ExceptionLogging("main_combinatorial", exc_flag=abort_flag) as el:
 
@@ -630,8 +940,8 @@ def main_combinatorial(args):
         if args.update_cache:
             qcount1 = count_dict_sum(qcounts1)
             qcount2 = count_dict_sum(qcounts2)
-            cache1 = dict_merge(qcaches1)
-            cache2 = dict_merge(qcaches2)
+            cache1 = dict_merge([read_cache(args.bc1_cache)] + list(deltas1))
+            cache2 = dict_merge([read_cache(args.bc2_cache)] + list(deltas2))
             store_cache(args.bc1_cache, cache1, qcount1)
             store_cache(args.bc2_cache, cache2, qcount2)
 
@@ -660,7 +970,8 @@ def process_dropseq(Qfq, Qres, args, Qerr, abort_flag, stat_lists):
         )
         out = Output(args, open_files=False)
         N = defaultdict(int)
-        for n_chunk, reads in queue_iter(Qfq, abort_flag):
+        for n_chunk, buf in queue_iter(Qfq, abort_flag):
+            reads = unpack_chunk(buf)
             el.logger.debug(f"received chunk {n_chunk} of {len(reads)} reads")
             results = []
             for fqid, r1, fqid2, r2, qual2 in reads:
@@ -673,9 +984,9 @@ def process_dropseq(Qfq, Qres, args, Qerr, abort_flag, stat_lists):
                     r2_qual=qual2,
                     r2_qname=fqid2,
                 )
-                results.append((True, rec))
+                results.append(("A", rec))
 
-            Qres.put((n_chunk, results))
+            Qres.put((n_chunk, pack_chunk(results)))
 
         # return our counts and observations
         # via these list proxies
@@ -1044,6 +1355,16 @@ def parse_args():
         type=float,
         help="minimal score for opseq alignment (default 22 [half of max])",
     )
+    parser.add_argument(
+        "--aligner",
+        default="PairwiseAligner",
+        choices=sorted(LOCAL_ALIGNERS.keys()),
+        help=(
+            "local aligner used to find the opseq primer site in read1. "
+            "'pairwise2' is the deprecated, much slower Biopython module used "
+            "previously (default=PairwiseAligner)"
+        ),
+    )
     parser.add_argument(
         "--threshold",
         default=0.5,
@@ -1062,6 +1383,26 @@ def parse_args():
     parser.add_argument(
         "--bc2-cache", default="", help="load cached BC2 alignments from here"
     )
+    parser.add_argument(
+        "--bc-neighborhood",
+        default=0,
+        type=int,
+        choices=[0, 1, 2],
+        help=(
+            "precompute BC1/BC2 assignments for all sequences within this many "
+            "mismatches of a reference barcode. Only far-off queries are then "
+            "aligned against all references (default=0, no index)"
+        ),
+    )
+    parser.add_argument(
+        "--cache-sync",
+        default=10,
+        type=int,
+        help=(
+            "share new BC1/BC2 alignments between workers every this many chunks "
+            "(default=10, 0=only at the end)"
+        ),
+    )
     parser.add_argument(
         "--update-cache",
         default=False,
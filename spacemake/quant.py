@@ -1,9 +1,11 @@
 import pysam
 import numpy as np
+import os
 import sys
 import logging
 import argparse
 from collections import defaultdict
+from spacemake.util import BarcodeCodec, UInt64Set
 
 
 def out_counts_bulk(f, counts, discard, stats):
@@ -21,6 +23,23 @@ def out_counts_bulk(f, counts, discard, stats):
         )
 
 
+def read_key_hash(seq, cell, umi):
+    return hash((seq, cell, umi)) & 0xFFFFFFFFFFFFFFFF
+
+
+def stable_read_key_hash(seq, cell, umi):
+    # unlike hash() of strings, this does not change between processes
+    from hashlib import blake2b
+
+    key = f"{seq}\t{cell}\t{umi}".encode("ascii")
+    return int.from_bytes(blake2b(key, digest_size=8).digest(), "little")
+
+
+def get_tag(aln, tag, default=None):
+    # cheaper than catching the KeyError pysam raises for a missing tag
+    return aln.get_tag(tag) if aln.has_tag(tag) else default
+
+
 class AlignmentClassifier:
     def __init__(
         self,
@@ -29,6 +48,8 @@ class AlignmentClassifier:
         gene_assign_mode="chrom",
         chrom_to_gene={},
         ignore_gf=["INTRONIC", "INTERGENIC"],
+        dedup_spill_dir="",
+        stable_hash=False,
     ):
         self.logger = logging.getLogger(f"AlignmentClassifier({sample_name})")
         self.sample_name = sample_name
@@ -41,7 +62,13 @@ class AlignmentClassifier:
             "gn_tag": self.parse_gn_gf,
         }[gene_assign_mode]
 
-        self.uniq_reads = set()
+        # 64-bit hashes of (sequence, CB, MI) seen so far. These need to be
+        # stable across processes if they are to be restored from a checkpoint
+        self.dedup_spill_dir = dedup_spill_dir
+        self.uniq_reads = UInt64Set(spill_dir=dedup_spill_dir)
+        self.key_hash = stable_read_key_hash if stable_hash else read_key_hash
+        self.n_reads = 0
+        self.n_dup = 0
 
     def fast_refname(self, aln):
         if not aln.tid in self.gene_names:
@@ -66,47 +93,128 @@ class AlignmentClassifier:
         else:
             return "multi_mapper"
 
-    def is_uniq(self, aln):
-        key = (aln.query_sequence, aln.get_tag("CB"), aln.get_tag("MI"))
-        u = key in self.uniq_reads
-        self.uniq_reads.add(u)
-        return u
+    def is_uniq(self, aln, cell, umi):
+        # 0 marks empty slots in the set
+        key = self.key_hash(aln.query_sequence, cell, umi) or 1
+        dup = self.uniq_reads.add(key)
+        self.n_reads += 1
+        self.n_dup += dup
+        return not dup
+
+    @property
+    def duplicate_rate(self):
+        return self.n_dup / max(self.n_reads, 1)
+
+    def get_state(self):
+        """
+        Position in the BAM (virtual offset after the last alignment that was
+        yielded) and duplicate detection state, for checkpointing.
+        """
+        return dict(
+            voffset=np.int64(self.bam.tell()),
+            n_reads=np.int64(self.n_reads),
+            n_dup=np.int64(self.n_dup),
+            uniq_reads=self.uniq_reads.to_array(),
+        )
+
+    def set_state(self, state):
+        self.bam.seek(int(state["voffset"]))
+        self.n_reads = int(state["n_reads"])
+        self.n_dup = int(state["n_dup"])
+        self.uniq_reads = UInt64Set.from_array(
+            state["uniq_reads"], spill_dir=self.dedup_spill_dir
+        )
 
     def __iter__(self):
         for aln in self.bam.fetch(until_eof=True):
+            cell = get_tag(aln, "CB", "NA")
+            umi = get_tag(aln, "MI", "NA")
             yield ClassifiedAlignment(
-                self, aln, self.get_gene(aln), is_dup=not self.is_uniq(aln)
+                self,
+                aln,
+                self.get_gene(aln),
+                is_dup=not self.is_uniq(aln, cell, umi),
+                cell=cell,
+                umi=umi,
             )
 
 
+NO_FLAGS = frozenset()
+
+
 class ClassifiedAlignment:
-    def __init__(self, parent, aln, gene, is_dup=False):
+    """
+    Per-alignment record with the results of the check_* methods. It is
+    allocated for every alignment, hence __slots__: only CB and MI are fetched
+    up-front (by the AlignmentClassifier). Other tags are looked up on demand, the full tag dict (.tags)
+    is only decoded if someone asks for it, and the flags set is only allocated
+    once a flag is actually raised.
+    """
+
+    __slots__ = (
+        "aln",
+        "parent",
+        "gene",
+        "is_dup",
+        "cell",
+        "umi",
+        "flags",
+        "_tags",
+        "clip5",
+        "clip3",
+        "n_match",
+        "short",
+        "reverse",
+        "primer",
+        "count",
+    )
+
+    def __init__(self, parent, aln, gene, is_dup=False, cell=None, umi=None):
         self.aln = aln
         self.parent = parent
-        self.tags = dict(aln.get_tags())
-        self.flags = set()
-        self.cell = self.tags.get("CB", "NA")
-        self.umi = self.tags.get("MI", "NA")
+        self._tags = None
+        self.flags = NO_FLAGS
+        self.cell = get_tag(aln, "CB", "NA") if cell is None else cell
+        self.umi = get_tag(aln, "MI", "NA") if umi is None else umi
         self.gene = gene
         self.is_dup = is_dup
 
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = dict(self.aln.get_tags())
+
+        return self._tags
+
+    def get_tag(self, tag, default=None):
+        if self._tags is not None:
+            return self._tags.get(tag, default)
+
+        return get_tag(self.aln, tag, default)
+
+    def add_flag(self, flag):
+        if self.flags is NO_FLAGS:
+            self.flags = set()
+
+        self.flags.add(flag)
+
     def check_qname(self, keywords=[]):
         for n in keywords:
             if n in self.aln.qname:
-                self.flags.add(f"name_has_{n}")
+                self.add_flag(f"name_has_{n}")
             else:
-                self.flags.add(f"name_missing_{n}")
+                self.add_flag(f"name_missing_{n}")
 
         return self
 
     def check_tags(self, **kw):
         for tag, keywords in kw.items():
-            tagval = self.tags.get(tag, "")
+            tagval = self.get_tag(tag, "")
             for n in keywords:
                 if n in tagval:
-                    self.flags.add(f"{tag}_has_{n}")
+                    self.add_flag(f"{tag}_has_{n}")
                 else:
-                    self.flags.add(f"{tag}_missing_{n}")
+                    self.add_flag(f"{tag}_missing_{n}")
 
         return self
 
@@ -136,9 +244,56 @@ class ClassifiedAlignment:
         return self
 
 
+def counts_to_adata(obs, var, rows, cols, counts, main_channel, is_sorted=False):
+    """
+    Builds the AnnData object of a DGE. rows and cols hold the cell and gene
+    index of every (cell, gene) pair and counts holds, for each channel, the
+    UMI and read counts of these pairs. The CSR structure is computed once and
+    re-used for all layers (pairs without counts in a channel become explicit
+    zeros), which makes this O(nnz) in numpy, no matter how many channels.
+    Pass is_sorted=True if the pairs already are in CSR order.
+    """
+    import scipy.sparse
+    import anndata
+
+    n_cells = len(obs)
+    n_genes = len(var)
+    if is_sorted:
+        order = slice(None)
+    else:
+        order = np.lexsort((cols, rows))
+
+    indices = cols[order]
+    indptr = np.zeros(n_cells + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_cells), out=indptr[1:])
+
+    def to_csr(data):
+        return scipy.sparse.csr_matrix(
+            (data[order], indices.copy(), indptr.copy()), shape=(n_cells, n_genes)
+        )
+
+    umi_counts, read_counts = counts[main_channel]
+    # convert to anndata object and store
+    adata = anndata.AnnData(to_csr(umi_counts))
+    adata.obs_names = obs
+    adata.var_names = var
+    adata.layers[f"reads_{main_channel}"] = to_csr(read_counts)
+
+    for channel, (umi_counts, read_counts) in sorted(counts.items()):
+        if channel == main_channel:
+            continue
+
+        adata.layers[channel] = to_csr(umi_counts)
+        adata.layers[f"reads_{channel}"] = to_csr(read_counts)
+
+    return adata
+
+
 class DGE:
     def __init__(self, _assert=False, main_channel="count"):
         self.main_channel = main_channel
+        # cells and UMIs are kept as 2-bit packed integer codes
+        self.codec = BarcodeCodec()
         self.DGE_umis = defaultdict(lambda: defaultdict(set))
         self.DGE_reads = defaultdict(lambda: defaultdict(int))
         self.DGE_cells = set()
@@ -158,7 +313,12 @@ class DGE:
         self._assert = _assert
         self.channels = set([main_channel])
 
+    def __len__(self):
+        return len(self.DGE_reads)
+
     def add_read(self, gene, cell, umi, channel="count"):
+        cell = self.codec.encode(cell)
+        umi = self.codec.encode(umi)
         self.DGE_cells.add(cell)
         self.DGE_genes.add(gene)
 
@@ -188,15 +348,13 @@ class DGE:
         return dup
 
     def make_DGEs(self):
-        import scipy.sparse
-        import anndata
-
         # count UMIs, reads across all channels into sparse arrays
         ind_of_cell = {}
         obs = []
-        for cell in sorted(self.DGE_cells):
+        names = [(self.codec.decode(cell), cell) for cell in self.DGE_cells]
+        for name, cell in sorted(names):
             ind_of_cell[cell] = len(obs)
-            obs.append(cell)
+            obs.append(name)
 
         ind_of_gene = {}
         var = []
@@ -204,61 +362,30 @@ class DGE:
             ind_of_gene[gene] = len(var)
             var.append(gene)
 
-        umi_counts_by_channel = defaultdict(list)
-        read_counts_by_channel = defaultdict(list)
-        row_ind = []
-        col_ind = []
-        for (gene, cell), umi_dict in self.DGE_umis.items():
-            for channel in self.channels:
-                umis = umi_dict[channel]
-                umi_counts_by_channel[channel].append(
-                    len(umis)
-                )  # <- the actual expression count
-                read_counts_by_channel[channel].append(
-                    self.DGE_reads[(gene, cell)][channel]
-                )
-
-            row_ind.append(ind_of_cell[cell])
-            col_ind.append(ind_of_gene[gene])
-
-        # print(
-        #     ">>>DIMENSION CHECK",
-        #     self.channels,
-        #     len(self.DGE_umis.items()),
-        #     [(k, len(v)) for k, v in umi_counts_by_channel.items()],
-        #     len(umi_counts_by_channel[self.main_channel]),
-        #     len(row_ind),
-        #     len(col_ind),
-        # )
-        X = scipy.sparse.csr_matrix(
-            (umi_counts_by_channel[self.main_channel], (row_ind, col_ind))
+        # one entry per (gene, cell) pair. DGE_reads has the same keys in the
+        # same order, as add_read() always inserts into both.
+        n = len(self.DGE_umis)
+        rows = np.fromiter(
+            (ind_of_cell[cell] for gene, cell in self.DGE_umis), dtype=np.int64, count=n
         )
-        # convert to anndata object and store
-        adata = anndata.AnnData(X)
-        adata.obs_names = obs
-        adata.var_names = var
-        adata.layers[f"reads_{self.main_channel}"] = scipy.sparse.csr_matrix(
-            (read_counts_by_channel[self.main_channel], (row_ind, col_ind))
+        cols = np.fromiter(
+            (ind_of_gene[gene] for gene, cell in self.DGE_umis), dtype=np.int64, count=n
         )
-
+        counts = {}
         for channel in self.channels:
-            if channel == self.main_channel:
-                continue
-
-            umi_counts = umi_counts_by_channel[channel]
-
-            adata.layers[channel] = scipy.sparse.csr_matrix(
-                (umi_counts, (row_ind, col_ind))
-            )
-            read_counts = read_counts_by_channel[channel]
-            adata.layers[f"reads_{channel}"] = scipy.sparse.csr_matrix(
-                (read_counts, (row_ind, col_ind))
+            umi_counts = np.fromiter(
+                (len(d.get(channel, ())) for d in self.DGE_umis.values()),
+                dtype=np.int32,
+                count=n,
+            )  # <- the actual expression count
+            read_counts = np.fromiter(
+                (d.get(channel, 0) for d in self.DGE_reads.values()),
+                dtype=np.int32,
+                count=n,
             )
-            # Do we want to keep the extra UMI or read counts?
-            # adata.layers[name] = aextra.layers["reads"]
+            counts[channel] = (umi_counts, read_counts)
 
-        # print(adata)
-        return adata
+        return counts_to_adata(obs, var, rows, cols, counts, self.main_channel)
 
     def check_DGEs_vs_margin_counts(self, ann_umis, ann_reads):
         import numpy as np
@@ -268,7 +395,7 @@ class DGE:
                 "DGE was not initialized with _assert = True, which is required for check_DGEs_vs_margin_counts()"
             )
 
-        cell_names = ann_umis.obs_names
+        cell_names = [self.codec.encode(n) for n in ann_umis.obs_names]
         gene_names = ann_umis.var_names
 
         def sets_to_vec(S, names):
@@ -319,6 +446,301 @@ class DGE:
         ).all()
 
 
+class ArrayDGE:
+    """
+    Memory-efficient drop-in for DGE. Genes, cells and UMIs are interned to
+    integer ids and each read is stored as one (gene, cell, umi, channel) record
+    in compact, growable typed arrays instead of nested dicts of sets.
+    Deduplication of UMIs happens only once, with np.unique, in make_DGEs(),
+    which builds the CSR matrices directly. The resulting AnnData is identical
+    to the one DGE produces.
+    Margin counters (_assert) are not supported and add_read() can not tell
+    whether a read is a UMI duplicate.
+    UMIs are stored directly as their 2-bit packed uint64 codes.
+    """
+
+    def __init__(self, main_channel="count"):
+        from array import array
+
+        self.main_channel = main_channel
+        self.codec = BarcodeCodec()
+        self.gene_ids = {}
+        self.cell_ids = {}
+        self.channel_ids = {}
+        self.channels = set([main_channel])
+
+        self.genes = array("I")
+        self.cells = array("I")
+        self.umis = array("Q")
+        self.chans = array("B")
+
+    def __len__(self):
+        return len(self.genes)
+
+    def add_read(self, gene, cell, umi, channel="count"):
+        ids = self.gene_ids
+        self.genes.append(ids.setdefault(gene, len(ids)))
+        ids = self.cell_ids
+        self.cells.append(ids.setdefault(self.codec.encode(cell), len(ids)))
+        self.umis.append(self.codec.encode(umi))
+        ids = self.channel_ids
+        self.chans.append(ids.setdefault(channel, len(ids)))
+        self.channels.add(channel)
+
+    def get_state(self):
+        """
+        The accumulated reads as a dict of plain numpy arrays, for checkpointing.
+        """
+        return dict(
+            genes=np.frombuffer(self.genes, dtype=np.uint32),
+            cells=np.frombuffer(self.cells, dtype=np.uint32),
+            umis=np.frombuffer(self.umis, dtype=np.uint64),
+            chans=np.frombuffer(self.chans, dtype=np.uint8),
+            # ids are assigned in insertion order
+            gene_names=np.array(list(self.gene_ids), dtype=str),
+            cell_codes=np.array(list(self.cell_ids), dtype=np.uint64),
+            channel_names=np.array(list(self.channel_ids), dtype=str),
+            channels=np.array(sorted(self.channels), dtype=str),
+            unpacked_seqs=np.array(self.codec.unpacked_seqs, dtype=str),
+        )
+
+    def set_state(self, state):
+        self.genes.frombytes(state["genes"].astype(np.uint32).tobytes())
+        self.cells.frombytes(state["cells"].astype(np.uint32).tobytes())
+        self.umis.frombytes(state["umis"].astype(np.uint64).tobytes())
+        self.chans.frombytes(state["chans"].astype(np.uint8).tobytes())
+
+        def intern(names):
+            return dict([(name, i) for i, name in enumerate(names)])
+
+        self.gene_ids = intern(state["gene_names"].tolist())
+        self.cell_ids = intern(state["cell_codes"].tolist())
+        self.channel_ids = intern(state["channel_names"].tolist())
+        self.channels = set(state["channels"].tolist())
+        # interning in the same order re-creates the same codes
+        for seq in state["unpacked_seqs"].tolist():
+            self.codec.encode(seq)
+
+    def collapse_umis(self):
+        """
+        Merges UMIs that differ by a single substitution from a more abundant
+        UMI of the same (cell, gene) into that UMI, across all channels (like
+        DropSeq with EDIT_DISTANCE=1). Within each (cell, gene), UMIs are
+        visited by decreasing read count and every UMI that is not merged yet
+        absorbs all of its unmerged neighbors. UMIs with N or longer than 31 nt
+        (interned codes) are never merged.
+        """
+        if not len(self):
+            return
+
+        groups = np.frombuffer(self.cells, dtype=np.uint32).astype(np.int64)
+        groups = groups * len(self.gene_ids) + np.frombuffer(self.genes, dtype=np.uint32)
+        # writable view, merged UMIs are replaced in-place
+        umis = np.frombuffer(self.umis, dtype=np.uint64)
+
+        # distinct (cell, gene, umi) combinations and their read counts
+        order = np.lexsort((umis, groups))
+        g = groups[order]
+        u = umis[order]
+        first = np.ones(len(g), dtype=bool)
+        first[1:] = (g[1:] != g[:-1]) | (u[1:] != u[:-1])
+        starts = np.flatnonzero(first)
+        d_group = g[starts]
+        d_umi = u[starts]
+        d_count = np.diff(np.append(starts, len(g)))
+        inverse = np.empty(len(g), dtype=np.int64)
+        inverse[order] = np.cumsum(first) - 1
+
+        # only (cell, gene) groups with more than one distinct UMI matter
+        g_first = np.ones(len(d_group), dtype=bool)
+        g_first[1:] = d_group[1:] != d_group[:-1]
+        g_rank = np.cumsum(g_first) - 1
+        g_size = np.bincount(g_rank)
+        packed = (d_umi < np.uint64(BarcodeCodec.sentinel)) & (g_size[g_rank] > 1)
+        packed = np.flatnonzero(packed)
+        if not len(packed):
+            return
+
+        # two UMIs are neighbors if they are identical after masking out the
+        # same single position. For each position, sorting by (group, masked
+        # code) puts all neighbors of a UMI next to each other.
+        n_nt = np.zeros(len(d_umi), dtype=np.int64)
+        n_nt[packed] = np.log2(d_umi[packed].astype(np.float64)).astype(np.int64) // 2
+        umi_bits = 2 * int(n_nt.max()) + 1
+        # if possible, use a single int64 sort key
+        single_key = int(g_rank[-1]).bit_length() + umi_bits <= 63
+
+        neighbors = defaultdict(list)
+        for i in range(int(n_nt.max())):
+            sel = packed[n_nt[packed] > i]
+            masked = d_umi[sel] & ~np.uint64(3 << (2 * i))
+            if single_key:
+                key = (g_rank[sel] << umi_bits) | masked.astype(np.int64)
+                order = np.argsort(key)
+                key = key[order]
+                key_change = key[1:] != key[:-1]
+            else:
+                order = np.lexsort((masked, g_rank[sel]))
+                masked = masked[order]
+                rank = g_rank[sel][order]
+                key_change = (masked[1:] != masked[:-1]) | (rank[1:] != rank[:-1])
+
+            sel = sel[order]
+            bounds = np.flatnonzero(np.concatenate([[True], key_change, [True]]))
+            multi = np.flatnonzero(np.diff(bounds) > 1)
+            for a, b in zip(bounds[multi].tolist(), bounds[multi + 1].tolist()):
+                run = sel[a:b].tolist()
+                for j in run:
+                    neighbors[j].extend([k for k in run if k != j])
+
+        if not neighbors:
+            return
+
+        parent = np.arange(len(d_umi))
+        merged = set()
+        # most abundant first, ties are broken by UMI code
+        for i in sorted(neighbors, key=lambda i: (-d_count[i], d_umi[i])):
+            if i in merged:
+                continue
+
+            merged.add(i)
+            for j in neighbors[i]:
+                if j not in merged:
+                    merged.add(j)
+                    parent[j] = i
+
+        umis[:] = d_umi[parent[inverse]]
+
+    @staticmethod
+    def sorted_ranks(ids, decode=None):
+        """
+        Sort names and return them together with the rank of each original id.
+        """
+        if not ids:
+            return [], np.empty(0, dtype=np.int64)
+
+        if decode is None:
+            names = sorted(ids)
+            order = [ids[n] for n in names]
+        else:
+            names, order = zip(*sorted([(decode(k), i) for k, i in ids.items()]))
+            names = list(names)
+
+        rank = np.empty(len(names), dtype=np.int64)
+        rank[list(order)] = np.arange(len(names))
+        return names, rank
+
+    def make_DGEs(self):
+        obs, cell_rank = self.sorted_ranks(self.cell_ids, decode=self.codec.decode)
+        var, gene_rank = self.sorted_ranks(self.gene_ids)
+        n_genes = len(var)
+
+        genes = np.frombuffer(self.genes, dtype=np.uint32)
+        cells = np.frombuffer(self.cells, dtype=np.uint32)
+        umis = np.frombuffer(self.umis, dtype=np.uint64)
+        chans = np.frombuffer(self.chans, dtype=np.uint8)
+
+        # every (cell, gene) pair seen in any channel is an entry in all matrices
+        # (explicit zeros where a channel has no reads), sorted like CSR wants it
+        key = cell_rank[cells] * n_genes + gene_rank[genes]
+        pairs, pair_idx = np.unique(key, return_inverse=True)
+        pair_idx = pair_idx.ravel()
+
+        def count(channel):
+            sel = chans == self.channel_ids.get(channel, -1)
+            p = pair_idx[sel]
+            u = umis[sel]
+            reads = np.bincount(p, minlength=len(pairs))
+            # the actual expression count: unique UMIs per (cell, gene)
+            order = np.lexsort((u, p))
+            p = p[order]
+            u = u[order]
+            first = np.ones(len(p), dtype=bool)
+            first[1:] = (p[1:] != p[:-1]) | (u[1:] != u[:-1])
+            umi_counts = np.bincount(p[first], minlength=len(pairs))
+            return umi_counts.astype(np.int32), reads.astype(np.int32)
+
+        counts = dict([(channel, count(channel)) for channel in self.channels])
+        return counts_to_adata(
+            obs,
+            var,
+            pairs // n_genes,
+            pairs % n_genes,
+            counts,
+            self.main_channel,
+            is_sorted=True,
+        )
+
+
+def save_checkpoint(path, bam_in, ac, dge):
+    """
+    Atomically replaces the checkpoint at path with the current state of the
+    AlignmentClassifier ac and the ArrayDGE dge.
+    """
+    state = dict(bam_in=np.array(bam_in), bam_size=np.int64(os.path.getsize(bam_in)))
+    state.update(ac.get_state())
+    state.update(dge.get_state())
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, **state)
+
+    os.replace(path + ".tmp", path)
+    ac.logger.info(f"saved checkpoint after {ac.n_reads} reads to '{path}'")
+
+
+def load_checkpoint(path, bam_in, ac, dge):
+    state = np.load(path)
+    if str(state["bam_in"]) != bam_in or state["bam_size"] != os.path.getsize(bam_in):
+        raise ValueError(
+            f"checkpoint '{path}' was made for '{state['bam_in']}', not '{bam_in}'"
+        )
+
+    ac.set_state(state)
+    dge.set_state(state)
+    ac.logger.info(f"resuming from checkpoint '{path}' after {ac.n_reads} reads")
+
+
+def merge_DGEs(adatas):
+    """
+    Merge AnnData objects of DGEs built from disjoint sets of cells (shards).
+    Genes are joined (missing counts are zero) and cells and genes are sorted
+    just like DGE.make_DGEs() would have done for all reads at once.
+    """
+    import scipy.sparse
+    import anndata
+
+    var = sorted(set().union(*[a.var_names for a in adatas]))
+    ind_of_gene = dict([(gene, i) for i, gene in enumerate(var)])
+    layers = set().union(*[a.layers.keys() for a in adatas])
+
+    obs = np.concatenate([np.asarray(a.obs_names, dtype=object) for a in adatas])
+    order = sorted(range(len(obs)), key=obs.__getitem__)
+
+    def stack(get_matrix):
+        blocks = []
+        for a in adatas:
+            m = get_matrix(a)
+            if m is None:
+                m = scipy.sparse.csr_matrix(a.shape, dtype=np.int64)
+
+            m = scipy.sparse.coo_matrix(m)
+            cols = np.array([ind_of_gene[g] for g in a.var_names], dtype=np.int64)
+            blocks.append(
+                scipy.sparse.csr_matrix(
+                    (m.data, (m.row, cols[m.col])), shape=(a.n_obs, len(var))
+                )
+            )
+
+        return scipy.sparse.vstack(blocks, format="csr")[order]
+
+    adata = anndata.AnnData(stack(lambda a: a.X))
+    adata.obs_names = list(obs[order])
+    adata.var_names = var
+    for name in sorted(layers):
+        adata.layers[name] = stack(lambda a: a.layers.get(name, None))
+
+    return adata
+
+
 # def assess_reads_per_UMI(ann_umis, ann_reads):
 #     rpu = (
 #         np.array(ann_reads.X.sum(axis=1), dtype=float).ravel()
@@ -399,6 +821,39 @@ def parse_cmdline():
         help="output a single-cell digital gene expression matrix with UMI COUNTS",
         default="",
     )
+    parser.add_argument(
+        "--dge-backend",
+        default="dict",
+        choices=["dict", "array"],
+        help="how to accumulate counts. 'array' stores integer-coded records instead of "
+        "nested sets and needs only a fraction of the memory (default=dict)",
+    )
+    parser.add_argument(
+        "--parallel",
+        default=1,
+        type=int,
+        help="number of worker processes. If > 1, alignments are sharded by cell barcode "
+        "prefix and each worker counts its own set of cells. Requires a CB tag on every "
+        "alignment (default=1)",
+    )
+    parser.add_argument(
+        "--prefix-size",
+        default=3,
+        type=int,
+        help="how many letters of the CB tag are used to shard alignments across workers "
+        "(default=3)",
+    )
+    parser.add_argument(
+        "--prefix-alphabet",
+        default="ACGTN",
+        help="alphabet of the CB prefixes (default=ACGTN)",
+    )
+    parser.add_argument(
+        "--dedup-spill-dir",
+        default="",
+        help="keep the table of PCR-duplicate hashes in a memory-mapped file in this "
+        "directory instead of RAM, for very large libraries (default='' -> off)",
+    )
     parser.add_argument(
         "--layers",
         default="reads",
@@ -443,8 +898,34 @@ def parse_cmdline():
         default="",
         help="discard if this string is present in qname (default='' -> off)",
     )
+    parser.add_argument(
+        "--checkpoint",
+        default="",
+        help="periodically save the accumulated counts and the position in the BAM to "
+        "this file. Requires --dge-backend=array and a BAM file (default='' -> off)",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        default=10000000,
+        type=int,
+        help="save a checkpoint every this many alignments (default=10000000)",
+    )
+    parser.add_argument(
+        "--resume",
+        default=False,
+        action="store_true",
+        help="continue from the --checkpoint file, if it exists",
+    )
+
+    args = parser.parse_args()
+    if args.checkpoint and args.dge_backend != "array":
+        parser.error("--checkpoint requires --dge-backend=array")
+    if args.checkpoint and args.parallel > 1:
+        parser.error("--checkpoint is not supported with --parallel")
+    if args.resume and not args.checkpoint:
+        parser.error("--resume requires --checkpoint")
 
-    return parser.parse_args()
+    return args
 
 
 def count_ligation_product(ca):
@@ -461,8 +942,8 @@ def count_everything(ca):
     return True
 
 
-if __name__ == "__main__":
-    args = parse_cmdline()
+def get_classifier(bam_in, args):
+    import pandas as pd
 
     lkup = {}
     if args.translate:
@@ -476,19 +957,27 @@ if __name__ == "__main__":
 
     ignore = args.ignore_gf.split(",")
 
+    return AlignmentClassifier(
+        args.sample_name,
+        bam_in,
+        chrom_to_gene=lkup,
+        gene_assign_mode=gene_mode,
+        ignore_gf=ignore,
+        dedup_spill_dir=args.dedup_spill_dir,
+        stable_hash=bool(args.checkpoint),
+    )
+
+
+def count_alignments(alignments, args, dge=None):
     count_func = {
         "ligation_product": count_ligation_product,
         "targeted_primer": count_targeted_primer,
         "everything": count_everything,
     }[args.count_func]
-    dge = DGE()
-    for ca in AlignmentClassifier(
-        args.sample_name,
-        args.bam_in,
-        chrom_to_gene=lkup,
-        gene_assign_mode=gene_mode,
-        ignore_gf=ignore,
-    ):
+    if dge is None:
+        dge = {"dict": DGE, "array": ArrayDGE}[args.dge_backend]()
+
+    for n, ca in enumerate(alignments, 1):
         ca = (
             # .check_qname(keywords=["TSO", "polyA"])
             ca.check_tags(
@@ -511,14 +1000,157 @@ if __name__ == "__main__":
                 # print("counting as", c)
                 dge.add_read(gene=ca.gene, cell=ca.cell, umi=ca.umi, channel=c)
 
+        if args.checkpoint and n % args.checkpoint_every == 0:
+            save_checkpoint(args.checkpoint, args.bam_in, alignments, dge)
+
         # print("next")
-    if args.output_DGE and len(dge.DGE_reads):
-        adata = dge.make_DGEs()
+    return dge
+
+
+def is_SAM_header(line):
+    return line.startswith("@")
+
+
+def CB_prefix_distributor(
+    input, outputs, prefix_size=3, prefix_alphabet="ACGTN", n=8, **kw
+):
+    "ensure that the FIFOs are not managed"
+    assert type(input) is str
+    logger = logging.getLogger("quant.CB_prefix_distributor")
+
+    from itertools import product
+    from mrfifo.fast_loops import distribute_by_substr
+
+    lkup = {}
+    i = 0
+    for letters in product(*([prefix_alphabet] * prefix_size)):
+        prefix = "".join(letters).encode("ascii")
+        lkup[prefix] = i % n
+        i += 1
+
+    # tag values that are one letter shorter than the prefix, such as 'NA'
+    for letters in product(*([prefix_alphabet] * (prefix_size - 1))):
+        prefix = "".join(letters).encode("ascii")
+        for end in [b"\t", b"\n"]:
+            lkup[prefix + end] = i % n
+        i += 1
+
+    logger.debug(f"distributing {input} to {outputs} by CB prefix size {prefix_size}")
+    try:
+        res = distribute_by_substr(
+            fin_name=input,
+            fifo_names=outputs,
+            sub_lookup=lkup,
+            sub_size=prefix_size,
+            sub_lead=b"\tCB:Z:",
+            # every worker needs the SAM header to parse its share of alignments
+            header_detect_func=is_SAM_header,
+            header_broadcast=True,
+        )
+    except ValueError as err:
+        # raised for the first alignment that lacks the CB tag
+        raise ValueError(
+            "--parallel shards alignments by their CB tag, but found an alignment "
+            f"without one. Use --parallel 1 for such BAM files. ({err})"
+        ) from err
+
+    logger.debug("distribution complete")
+    return res
+
+
+def quant_worker(input, args, **kw):
+    "ensure that the input FIFO is not managed, pysam opens it directly"
+    ac = get_classifier(input, args)
+    dge = count_alignments(ac, args)
+    adata = dge.make_DGEs() if len(dge) else None
+    return adata, ac.n_reads, ac.n_dup
+
+
+def quant_parallel(args):
+    import mrfifo as mf
+
+    w = (
+        mf.Workflow("quant", total_pipe_buffer_MB=4)
+        .BAM_reader(
+            input=args.bam_in,
+            mode="Sh",
+            threads=2,
+        )
+        .distribute(
+            input=mf.FIFO("input_sam", "rt"),
+            outputs=mf.FIFO("dist_{n}", "wt", n=args.parallel),
+            func=CB_prefix_distributor,
+            prefix_size=args.prefix_size,
+            prefix_alphabet=args.prefix_alphabet,
+            n=args.parallel,
+        )
+        .workers(
+            func=quant_worker,
+            input=mf.FIFO("dist_{n}", "rt"),
+            args=args,
+            n=args.parallel,
+            _manage_fifos=False,
+        )
+        .run()
+    )
+    adatas = []
+    n_dist = 0
+    n_reads = 0
+    n_dup = 0
+    for jobname, res in sorted(w.result_dict.items()):
+        if "dist" in jobname:
+            n_dist += res
+        elif "worker" in jobname:
+            adata, n, d = res
+            n_reads += n
+            n_dup += d
+            if adata is not None:
+                adatas.append(adata)
+
+    if n_reads != n_dist:
+        # the distributor skips alignments whose CB prefix is not in the lookup
+        raise ValueError(
+            f"only {n_reads} of {n_dist} alignments were counted. The CB tags of "
+            f"the others do not start with {args.prefix_size} letters from "
+            f"--prefix-alphabet={args.prefix_alphabet}"
+        )
+
+    adata = merge_DGEs(adatas) if adatas else None
+    return adata, n_reads, n_dup
+
+
+if __name__ == "__main__":
+    args = parse_cmdline()
+
+    if args.parallel > 1:
+        adata, n_reads, n_dup = quant_parallel(args)
+    else:
+        ac = get_classifier(args.bam_in, args)
+        dge = None
+        if args.checkpoint:
+            dge = ArrayDGE()
+            if args.resume and os.path.exists(args.checkpoint):
+                load_checkpoint(args.checkpoint, args.bam_in, ac, dge)
+
+        dge = count_alignments(ac, args, dge=dge)
+        adata = dge.make_DGEs() if args.output_DGE and len(dge) else None
+        n_reads, n_dup = ac.n_reads, ac.n_dup
+
+    sys.stderr.write(
+        f"### PCR duplicates: {n_dup} of {n_reads} reads "
+        f"({100.0 * n_dup / max(n_reads, 1):.2f} %)\n"
+    )
+
+    if args.output_DGE and adata is not None:
         # dge.check_DGEs_vs_margin_counts(ann_umis, ann_reads)
         # print("storing AnnData object")
         adata.write(args.output_DGE)
         # ann_reads.write(args.output_DGE_reads)
 
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        # the run is complete, nothing left to resume
+        os.remove(args.checkpoint)
+
         # sys.stderr.write(
         #     f"### reads-to-UMI ratio quartiles: {assess_reads_per_UMI(ann_umis, ann_reads)} \n"
         # )
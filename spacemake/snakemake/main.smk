@@ -461,15 +461,15 @@ rule create_dge:
         """
         mkdir -p {params.dge_root}
 
-        {dropseq_tools}/DigitalExpression \
-        -m 16g \
-        I= {input.reads}\
-        O= {output.dge} \
-        SUMMARY= {output.dge_summary} \
-        CELL_BC_FILE={input.top_barcodes} \
-        CELL_BARCODE_TAG={params.cell_barcode_tag} \
-        MOLECULAR_BARCODE_TAG={params.umi_tag} \
-        TMP_DIR={global_tmp} \
+        python {spacemake_dir}/bin/DigitalExpression.py \
+        --input {input.reads} \
+        --output {output.dge} \
+        --summary {output.dge_summary} \
+        --cell-bc-file {input.top_barcodes} \
+        --cell-barcode-tag {params.cell_barcode_tag} \
+        --umi-tag {params.umi_tag} \
+        --sample {wildcards.sample_id} \
+        --log-file {params.dge_root}/DigitalExpression.log \
         {params.dge_extra_params}
         """
 
@@ -484,9 +484,8 @@ rule create_h5ad_dge:
         if wildcards.is_external == '.external':
             adata = load_external_dge(input['dge'])
         else:
-            adata = dge_to_sparse_adata(
-                input['dge'],
-                input['dge_summary'])
+            # already a sparse h5ad with all metrics, see create_dge
+            adata = sc.read_h5ad(input['dge'])
         # attach barcodes
         if 'barcode_file' in input.keys() and wildcards.n_beads == 'spatial':
             adata = attach_barcode_file(adata, input['barcode_file'])
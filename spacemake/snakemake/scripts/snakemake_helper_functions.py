@@ -524,21 +524,18 @@ def get_dge_extra_params(wildcards):
     if dge_type == ".exon":
         extra_params = ""
     elif dge_type == ".intron":
-        extra_params = "LOCUS_FUNCTION_LIST=null LOCUS_FUNCTION_LIST=INTRONIC"
+        extra_params = "--locus-function INTRONIC"
     elif dge_type == ".all":
-        extra_params = "LOCUS_FUNCTION_LIST=INTRONIC"
+        extra_params = "--locus-function CODING UTR INTRONIC"
     if dge_type == ".Reads_exon":
-        extra_params = "OUTPUT_READS_INSTEAD=true"
+        extra_params = "--output-reads-instead"
     elif dge_type == ".Reads_intron":
-        extra_params = (
-            "OUTPUT_READS_INSTEAD=true LOCUS_FUNCTION_LIST=null"
-            + "LOCUS_FUNCTION_LIST=INTRONIC"
-        )
+        extra_params = "--output-reads-instead --locus-function INTRONIC"
     elif dge_type == ".Reads_all":
-        extra_params = "OUTPUT_READS_INSTEAD=true LOCUS_FUNCTION_LIST=INTRONIC"
+        extra_params = "--output-reads-instead --locus-function CODING UTR INTRONIC"
 
     if wildcards.mm_included == ".mm_included":
-        extra_params = extra_params + " READ_MQ=0"
+        extra_params = extra_params + " --read-mq 0"
 
     return extra_params
 
@@ -4,6 +4,7 @@ import pandas as pd
 
 # import cutadapt.align
 from collections import defaultdict
+from spacemake.util import BarcodeCodec, pack_seq
 
 __version__ = "0.9"
 __author__ = ["Marvin Jens"]
@@ -107,6 +108,7 @@ class AbundantRNATagger:
         self.bam = bam
         self.tid_lkup = {}
         self.umi = set()
+        self.codec = BarcodeCodec()
 
         self.counter = defaultdict(int)
         self.tag_names_to_count = ["af", "an"]
@@ -120,7 +122,12 @@ class AbundantRNATagger:
         name = self.cached_name_for_tid(aln.tid)
         _tags = aln.get_tags()
         tags = dict(_tags)
-        key = (aln.query_sequence, tags.get("CB", "NA"), tags.get("MI", "NA"))
+        seq = aln.query_sequence
+        key = (
+            pack_seq(seq) or seq,
+            self.codec.encode(tags.get("CB", "NA")),
+            self.codec.encode(tags.get("MI", "NA")),
+        )
 
         if key in self.umi:
             ax = "PCR"
@@ -283,7 +290,12 @@ class GenomeTagger(AbundantRNATagger):
             tags.get("gs", "").split(","),
         )
 
-        key = (aln.query_sequence[:20], tags.get("CB", "NA"), tags.get("MI", "NA"))
+        seq = aln.query_sequence[:20]
+        key = (
+            pack_seq(seq) or seq,
+            self.codec.encode(tags.get("CB", "NA")),
+            self.codec.encode(tags.get("MI", "NA")),
+        )
 
         if key in self.umi:
             ax = "PCR"
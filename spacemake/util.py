@@ -342,6 +342,181 @@ def rev_comp(seq):
     return complement(seq)[::-1]
 
 
+PACK_TABLE = str.maketrans("ACGT", "0123")
+
+
+def pack_seq(seq):
+    """
+    Packs a nucleotide sequence into an integer with 2 bits per base (A=0, C=1,
+    G=2, T=3), behind a leading 1 that keeps sequences of different length
+    apart. There is no length limit, but only sequences of up to 31 nt fit into
+    63 bits. Returns None if seq contains anything other than ACGT (or is not
+    a string at all, e.g. a missing query sequence).
+    """
+    try:
+        # int() would also accept the digits 0-3, '_' and whitespace
+        if seq and not seq.isalpha():
+            return None
+
+        return int("1" + seq.translate(PACK_TABLE), 4)
+    except (ValueError, AttributeError):
+        return None
+
+
+class BarcodeCodec:
+    """
+    Bijective mapping of UMIs and cell barcodes to integers that fit into an
+    np.uint64. Sequences of up to 31 nt are packed with pack_seq(). Everything
+    else (N or other characters, longer sequences, "NA") is interned and gets a
+    code from the sentinel range, which has the top bit set.
+    """
+
+    max_len = 31
+    sentinel = 1 << 63
+
+    def __init__(self):
+        self.unpacked = {}
+        self.unpacked_seqs = []
+
+    def encode(self, seq):
+        if len(seq) <= self.max_len:
+            code = pack_seq(seq)
+            if code is not None:
+                return code
+
+        code = self.unpacked.get(seq)
+        if code is None:
+            code = self.sentinel + len(self.unpacked_seqs)
+            self.unpacked[seq] = code
+            self.unpacked_seqs.append(seq)
+
+        return code
+
+    def decode(self, code):
+        if code >= self.sentinel:
+            return self.unpacked_seqs[code - self.sentinel]
+
+        nts = []
+        while code > 1:
+            nts.append("ACGT"[code & 3])
+            code >>= 2
+
+        return "".join(reversed(nts))
+
+
+class UInt64Set:
+    """
+    Compact set of non-zero 64-bit integers (e.g. hash values). Open addressing
+    with linear probing in a flat uint64 table (0 marks an empty slot), which
+    is kept at most half full: 16-32 bytes per element instead of a Python
+    set entry plus the object it refers to. If spill_dir is given, the table
+    is a memory-mapped temporary file in that directory, so that the OS can
+    page it out to disk for very large sets.
+    """
+
+    def __init__(self, capacity=1 << 16, spill_dir=""):
+        self.spill_dir = spill_dir
+        self.n = 0
+        self.alloc(capacity)
+
+    def alloc(self, capacity):
+        import numpy as np
+
+        size = 1 << max(4, (2 * capacity - 1).bit_length())
+        if self.spill_dir:
+            import tempfile
+
+            self.spill_file = tempfile.TemporaryFile(dir=self.spill_dir)
+            self.table = np.memmap(
+                self.spill_file, dtype=np.uint64, mode="w+", shape=(size,)
+            )
+        else:
+            self.table = np.zeros(size, dtype=np.uint64)
+
+        # indexing a memoryview is much faster than indexing the array
+        self.slots = memoryview(self.table)
+        self.mask = size - 1
+        self.max_n = size // 2
+
+    def add(self, x):
+        """
+        Adds x and returns True if x was already in the set.
+        """
+        slots = self.slots
+        mask = self.mask
+        i = x & mask
+        while True:
+            y = slots[i]
+            if y == x:
+                return True
+            if y == 0:
+                break
+            i = (i + 1) & mask
+
+        slots[i] = x
+        self.n += 1
+        if self.n > self.max_n:
+            self.grow()
+
+        return False
+
+    def __contains__(self, x):
+        slots = self.slots
+        mask = self.mask
+        i = x & mask
+        while True:
+            y = slots[i]
+            if y == x:
+                return True
+            if y == 0:
+                return False
+            i = (i + 1) & mask
+
+    def __len__(self):
+        return self.n
+
+    def to_array(self):
+        return self.table[self.table != 0]
+
+    @classmethod
+    def from_array(cls, keys, spill_dir=""):
+        """
+        Creates the set from an array of distinct non-zero keys, as returned
+        by to_array().
+        """
+        s = cls(capacity=max(len(keys), 1 << 16), spill_dir=spill_dir)
+        s.place(keys)
+        s.n = len(keys)
+        return s
+
+    def grow(self):
+        old = self.table
+        keys = old[old != 0]
+        self.slots.release()
+        self.alloc(2 * self.n)
+        del old
+        self.place(keys)
+
+    def place(self, keys):
+        import numpy as np
+
+        # insert keys that are not in the table yet, all at once. In each
+        # round every key that is not placed yet probes the next slot. If that
+        # slot is free, the first of the keys that probe it takes it.
+        table = self.table
+        slot = (keys & np.uint64(self.mask)).astype(np.int64)
+        while len(keys):
+            free = np.flatnonzero(table[slot] == 0)
+            _, first = np.unique(slot[free], return_index=True)
+            placed = free[first]
+            table[slot[placed]] = keys[placed]
+
+            left = np.ones(len(keys), dtype=bool)
+            left[placed] = False
+            keys = keys[left]
+            slot = (slot[left] + 1) & self.mask
+
+
 def fasta_chunks(lines, strip=True, fuse=True):
     chunk = ""
     data = []
@@ -0,0 +1,221 @@
+import pytest
+import os
+import random
+import pysam
+
+from spacemake.annotator import *
+
+
+spacemake_dir = os.path.dirname(__file__) + "/../"
+test_gtf = spacemake_dir + "test_data/test_annotation.gtf.gz"
+
+
+@pytest.fixture(scope="module")
+def test_bam(tmp_path_factory):
+    # random spliced and unspliced alignments, both strands, across the
+    # contigs of the test annotation
+    lens = {}
+    for line in gzip.open(test_gtf, "rt"):
+        parts = line.split("\t")
+        lens[parts[0]] = max(lens.get(parts[0], 0), int(parts[4]) + 500)
+
+    names = sorted(lens)
+    header = {"HD": {"VN": "1.6"}, "SQ": [{"SN": n, "LN": lens[n]} for n in names]}
+    path = (tmp_path_factory.mktemp("annotator") / "test.bam").as_posix()
+
+    rnd = random.Random(1)
+    out = pysam.AlignmentFile(path, "wb", header=header)
+    for i in range(20000):
+        aln = pysam.AlignedSegment(out.header)
+        aln.query_name = f"r{i}"
+        aln.query_sequence = "A" * 60
+        aln.query_qualities = pysam.qualitystring_to_array("E" * 60)
+        aln.reference_id = rnd.randrange(len(names))
+        aln.reference_start = rnd.randrange(0, lens[names[aln.reference_id]] - 3000)
+        aln.flag = 16 if rnd.random() < 0.5 else 0
+        if rnd.random() < 0.3:
+            aln.cigarstring = f"5S20M{rnd.randrange(50, 2000)}N35M"
+        else:
+            aln.cigarstring = "60M"
+        aln.mapping_quality = 255
+        out.write(aln)
+
+    out.close()
+    return path
+
+
+@pytest.fixture(scope="module")
+def gtf_df(tmp_path_factory):
+    path = (tmp_path_factory.mktemp("annotator") / "test_annotation.tsv").as_posix()
+    GenomeAnnotation.from_GTF(test_gtf, df_cache=path)
+    return path
+
+
+def annotate(src, out, ga, **kw):
+    ga.annotate_BAM(src, out, **kw)
+    return [
+        (aln.query_name, aln.get_tags())
+        for aln in pysam.AlignmentFile(out, check_sq=False).fetch(until_eof=True)
+    ]
+
+
+def test_cache_keeps_order(gtf_df):
+    ga = GenomeAnnotation.from_uncompiled_df(gtf_df, cache_size=100)
+    classifier = ga.classifier
+    rnd = random.Random(1)
+    n_reordered = 0
+    for n in range(2000):
+        # like a spliced read, overlapping features at two distant loci
+        chrom, strand = rnd.choice(ga.strand_keys)
+        starts = ga.strand_intervals[(chrom, strand)][0]
+        group = set()
+        for start in rnd.sample(list(starts), 2):
+            group |= ga.query_idx(chrom, start, start + rnd.randrange(1, 2000), strand)
+
+        # equal sets, built differently, may iterate in a different order
+        a = frozenset(sorted(group))
+        b = frozenset(sorted(group, reverse=True))
+        n_reordered += list(a) != list(b)
+        for idx in [a, b]:
+            assert classifier.process(idx) == classifier.classify(idx)
+
+    assert n_reordered > 0
+
+
+@pytest.mark.parametrize("parallel", [1, 3])
+def test_cached_vs_uncached(gtf_df, test_bam, tmp_path, parallel):
+    uncached = annotate(
+        test_bam,
+        (tmp_path / "uncached.bam").as_posix(),
+        GenomeAnnotation.from_uncompiled_df(gtf_df, cache_size=0),
+    )
+    cached = annotate(
+        test_bam,
+        (tmp_path / "cached.bam").as_posix(),
+        GenomeAnnotation.from_uncompiled_df(gtf_df, cache_size=100),
+        parallel=parallel,
+    )
+    assert cached == uncached
+
+
+def test_serial_vs_parallel(gtf_df, test_bam, tmp_path):
+    for cache_size in [0, 100000]:
+        ga = GenomeAnnotation.from_uncompiled_df(gtf_df, cache_size=cache_size)
+        serial = annotate(test_bam, (tmp_path / "serial.bam").as_posix(), ga)
+        parallel = annotate(
+            test_bam, (tmp_path / "parallel.bam").as_posix(), ga, parallel=3
+        )
+        assert serial == parallel
+
+    ga = GenomeAnnotation.from_uncompiled_df(gtf_df).compile(
+        (tmp_path / "compiled").as_posix(), gtf=test_gtf
+    )
+    serial = annotate(test_bam, (tmp_path / "serial_c.bam").as_posix(), ga)
+    parallel = annotate(
+        test_bam, (tmp_path / "parallel_c.bam").as_posix(), ga, parallel=3
+    )
+    assert serial == parallel
+
+
+def test_parallel_close_early(gtf_df, test_bam):
+    import signal
+    import multiprocessing as mp
+    from spacemake.parallel import chunkify
+
+    ga = GenomeAnnotation.from_uncompiled_df(gtf_df)
+    bam = pysam.AlignmentFile(test_bam, check_sq=False)
+    chunks = chunkify(bam.fetch(until_eof=True), n_chunk=500)
+    g = ga.annotate_chunks_parallel(chunks, bam.references, n_workers=3)
+
+    # fail instead of hanging if the workers are never released
+    signal.alarm(60)
+    try:
+        reads, tags = next(g)
+        assert len(reads) == len(tags) == 500
+        g.close()
+    finally:
+        signal.alarm(0)
+
+    assert mp.active_children() == []
+
+
+def test_compiled_save(gtf_df, tmp_path):
+    path = (tmp_path / "compiled").as_posix()
+    ga = GenomeAnnotation.from_uncompiled_df(gtf_df).compile(path, gtf=test_gtf)
+    assert os.listdir(path) == ["compiled_annotation.bin"]
+    assert CompiledIndex.is_current(path, test_gtf)
+
+
+def test_table_is_current(tmp_path):
+    gtf = tmp_path / "test.gtf"
+    table = tmp_path / "test.tsv"
+    assert not table_is_current(table.as_posix(), gtf.as_posix())
+
+    gtf.write_text("")
+    table.write_text("")
+    os.utime(gtf, ns=(1000, 1000))
+    assert table_is_current(table.as_posix(), gtf.as_posix())
+
+    # the GTF changed after the table was written
+    os.utime(table, ns=(0, 0))
+    assert not table_is_current(table.as_posix(), gtf.as_posix())
+
+
+def ncls_decompose(nc):
+    """
+    The previous, query based decompose(): scans every breakpoint of the NCLS
+    until the set of overlapping features changes.
+    """
+    starts, ends, ids = np.array(nc.intervals()).T
+    breakpoints = np.array(sorted(set(starts) | set(ends)))
+    if not len(starts):
+        return
+
+    last_pos = breakpoints[0]
+    last_key = query(nc, last_pos, last_pos + 1)
+    for bp in breakpoints[1:]:
+        for x in [-1, 0, +1]:
+            if bp + x <= last_pos:
+                continue
+
+            key = query(nc, bp + x, bp + x + 1)
+            if key != last_key:
+                if len(last_key):
+                    yield int(last_pos), int(bp + x), last_key
+                last_key = key
+                last_pos = bp + x
+                break
+
+
+def test_decompose_random():
+    from ncls import NCLS64
+
+    rnd = np.random.default_rng(1)
+    for n in range(300):
+        n = rnd.integers(1, 60)
+        starts = rnd.integers(0, 200, n)
+        ends = starts + rnd.integers(0, 30, n)
+        ids = np.arange(n) * 3 + 7
+        nc = NCLS64(starts, ends, ids)
+        assert list(decompose(starts, ends, ids)) == list(ncls_decompose(nc))
+
+
+def test_decompose_gtf(gtf_df):
+    from ncls import NCLS64
+
+    df = load_table(gtf_df)
+    classify = GTFClassifier(df).process
+    intervals = GenomeAnnotation.intervals_from_df(df)
+    for (chrom, strand), (starts, ends, ids) in intervals.items():
+        if starts.min() < 0:
+            # NCLS64.intervals() mangles features starting before 0, which
+            # made the previous compiler drift by one nt on this strand
+            continue
+
+        nc = NCLS64(starts, ends, ids.astype(np.int64))
+        old = list(ncls_decompose(nc))
+        new = list(decompose(starts, ends, ids))
+        assert [(s, e) for s, e, key in new] == [(s, e) for s, e, key in old]
+        for (s, e, key), (s_old, e_old, key_old) in zip(new, old):
+            assert key == key_old
+            assert classify(key) == classify(key_old)
@@ -0,0 +1,72 @@
+import pytest
+import random
+import numpy as np
+
+from spacemake.preprocess.fastq import *
+
+
+def random_seq(rnd, n, alphabet="ACGT"):
+    return "".join(rnd.choices(alphabet, k=n))
+
+
+@pytest.fixture(scope="module")
+def barcode_fa(tmp_path_factory):
+    rnd = random.Random(0)
+    path = tmp_path_factory.mktemp("fastq") / "barcodes.fa"
+    with open(path, "wt") as f:
+        for i in range(500):
+            f.write(f">bc{i}\n{random_seq(rnd, rnd.choice([8, 8, 9, 10]))}\n")
+
+        # tied references
+        f.write(">dupA\nACGTACGT\n>dupB\nACGTACGT\n")
+
+    return path.as_posix()
+
+
+def test_hamming_matrix():
+    rnd = random.Random(1)
+    for L in [1, 4, 8, 12]:
+        queries = [random_seq(rnd, L, "ACGTN") for i in range(50)]
+        refs = [random_seq(rnd, L) for i in range(30)]
+        costs = np.array([rnd.choice([0, 1, 2, 3]) for i in range(L)])
+        scores = hamming_matrix(
+            seqs_to_matrix(queries, L), seqs_to_matrix(refs, L), costs
+        )
+        assert scores.shape == (len(queries), len(refs))
+        for q, row in zip(queries, scores):
+            assert row.tolist() == [hamming(q, r, costs) for r in refs]
+
+
+def scalar_align(matcher, query):
+    "the previous, one reference at a time BarcodeMatcher.align()"
+    if len(query) < matcher.lmin:
+        return [NO_CALL], [NO_CALL], [-1]
+
+    lq = min(len(query), matcher.lmax)
+    if matcher.length_specific:
+        sel = matcher.slen_masks[lq]
+    else:
+        sel = np.arange(len(matcher.seqs))
+
+    seqs = matcher.seqs[sel]
+    scores = np.array([hamming(query, s, matcher.costs[lq]) for s in seqs])
+    ties = scores == scores.max()
+    return matcher.names[sel][ties], seqs[ties], scores[ties]
+
+
+@pytest.mark.parametrize("place", ["left", "right"])
+@pytest.mark.parametrize("length_specific", [True, False])
+def test_align_batch(barcode_fa, place, length_specific):
+    rnd = random.Random(2)
+    matcher = BarcodeMatcher(barcode_fa, length_specific=length_specific, place=place)
+    queries = [random_seq(rnd, rnd.choice([5, 7, 8, 9, 10, 12])) for i in range(500)]
+    queries += ["ACGTACGT", "ACGTACGA", "AAAAAAAA", ""]
+    # references with an N
+    queries += [s[:4] + "N" + s[5:] for s in matcher.seqs[:50]]
+
+    batch = matcher.align_batch(queries)
+    for query, res in zip(queries, batch):
+        ref = scalar_align(matcher, query)
+        single = matcher.align(query)
+        for x, y, z in zip(ref, single, res):
+            assert list(x) == list(y) == list(z)
@@ -0,0 +1,34 @@
+import pytest
+import random
+import multiprocessing as mp
+
+from spacemake.parallel import *
+
+
+def random_record(rnd):
+    name = f"@read{rnd.randrange(1 << 30)} 1:N:0:ACGT"
+    seq = "".join(rnd.choices("ACGTN", k=rnd.randrange(0, 150)))
+    qual = "".join(rnd.choices("!#5:?AEFGI", k=len(seq)))
+    return name, seq, qual
+
+
+@pytest.mark.parametrize("n_fields", [1, 2, 3, 4])
+def test_pack_chunk_roundtrip(n_fields):
+    rnd = random.Random(n_fields)
+    for n in [0, 1, 1000]:
+        items = [
+            tuple(random_record(rnd) + ("", "\tCB:Z:ÄÖ\n"))[:n_fields]
+            for i in range(n)
+        ]
+        buf = pack_chunk(items)
+        assert type(buf) is bytes
+        assert unpack_chunk(buf) == items
+
+
+def test_pack_chunk_queue():
+    rnd = random.Random(1)
+    items = [random_record(rnd) for i in range(1000)]
+    Q = mp.Queue()
+    Q.put((0, pack_chunk(items)))
+    n_chunk, buf = Q.get(timeout=10)
+    assert unpack_chunk(buf) == items
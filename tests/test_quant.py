@@ -0,0 +1,48 @@
+import pytest
+import numpy as np
+
+from spacemake.quant import *
+
+
+def random_reads(n, seed=0):
+    rnd = np.random.default_rng(seed)
+    genes = [f"G{i}" for i in rnd.integers(0, 200, n)]
+    cells = [f"C{i:04d}" for i in rnd.integers(0, 300, n)]
+    cells = [c if i % 50 else "NA" for i, c in enumerate(cells)]
+    umis = [
+        "".join(u)
+        for u in rnd.choice(list("ACGTN"), size=(n, 6), p=[0.24] * 4 + [0.04])
+    ]
+    chans = rnd.choice(["count", "short", "reverse", "primer"], n).tolist()
+    return list(zip(genes, cells, umis, chans))
+
+
+def make_DGEs(cls, reads):
+    dge = cls()
+    for gene, cell, umi, channel in reads:
+        dge.add_read(gene=gene, cell=cell, umi=umi, channel=channel)
+
+    return dge.make_DGEs()
+
+
+def assert_same_adata(a, b):
+    assert list(a.obs_names) == list(b.obs_names)
+    assert list(a.var_names) == list(b.var_names)
+    assert set(a.layers.keys()) == set(b.layers.keys())
+    for x, y in [(a.X, b.X)] + [(a.layers[k], b.layers[k]) for k in a.layers.keys()]:
+        assert x.shape == y.shape
+        assert x.dtype == y.dtype
+        assert (x != y).nnz == 0
+
+
+@pytest.mark.parametrize("n", [1, 10, 10000])
+def test_array_vs_dict_DGE(n):
+    reads = random_reads(n)
+    assert_same_adata(make_DGEs(DGE, reads), make_DGEs(ArrayDGE, reads))
+
+
+def test_empty_DGE():
+    a = make_DGEs(DGE, [])
+    b = make_DGEs(ArrayDGE, [])
+    assert b.shape == (0, 0)
+    assert_same_adata(a, b)
@@ -0,0 +1,69 @@
+import pytest
+import random
+import numpy as np
+
+from spacemake.util import *
+
+
+def test_pack_seq():
+    assert pack_seq("") == 1
+    assert pack_seq("A") == 4
+    assert pack_seq("T") == 7
+    assert pack_seq("AC") == 0b10001
+    # not (only) ACGT, or not a string at all
+    for seq in ["N", "ACGN", "acgt", "0123", "A_C", " AC", "NA", None, 42]:
+        assert pack_seq(seq) is None
+
+    # leading A's do not collide with shorter sequences
+    assert len({pack_seq("A" * n) for n in range(32)}) == 32
+    assert pack_seq("T" * 31) < 1 << 63
+
+
+def test_barcode_codec_roundtrip():
+    rnd = random.Random(1)
+    seqs = ["", "NA", "A" * 31, "A" * 32, "T" * 40, "ACGTN", "-"]
+    seqs += ["".join(rnd.choices("ACGTN", k=rnd.randrange(1, 40))) for n in range(5000)]
+
+    codec = BarcodeCodec()
+    codes = [codec.encode(seq) for seq in seqs]
+    assert all(0 <= code < 1 << 64 for code in codes)
+    assert [codec.decode(code) for code in codes] == seqs
+    # bijective: equal sequences, and only those, get equal codes
+    assert len(set(codes)) == len(set(seqs))
+    assert [codec.encode(seq) for seq in seqs] == codes
+
+    # packed and interned codes do not overlap
+    assert codec.encode("A" * 31) < BarcodeCodec.sentinel
+    assert codec.encode("A" * 32) >= BarcodeCodec.sentinel
+    assert codec.encode("NA") >= BarcodeCodec.sentinel
+
+
+@pytest.mark.parametrize("spill", [False, True])
+def test_uint64_set(tmp_path, spill):
+    rnd = random.Random(1)
+    keys = [rnd.randrange(1, 1 << 64) for n in range(50000)]
+    # collide in the low bits, which are used as the slot index
+    keys += [(n << 40) + 1 for n in range(1, 1000)]
+    keys += keys[:1000]
+
+    s = UInt64Set(capacity=16, spill_dir=tmp_path.as_posix() if spill else "")
+    ref = set()
+    for x in keys:
+        assert s.add(x) == (x in ref)
+        ref.add(x)
+
+    assert len(s) == len(ref)
+    assert all(x in s for x in ref)
+    others = [rnd.randrange(1, 1 << 64) for n in range(10000)]
+    assert [x in s for x in others] == [x in ref for x in others]
+
+    arr = s.to_array()
+    assert arr.dtype == np.uint64
+    assert set(arr.tolist()) == ref
+
+    s2 = UInt64Set.from_array(arr)
+    assert len(s2) == len(ref)
+    assert all(x in s2 for x in ref)
+    assert [x in s2 for x in others] == [x in ref for x in others]
+    assert not s2.add(1 << 63)
+    assert s2.add(1 << 63)